@@ -0,0 +1,178 @@
+"""An asyncio heapdict for scheduling deadlines on an event loop.
+
+It uses asyncio.get_running_loop(), so it needs Python 3.7 or later."""
+import asyncio
+from collections.abc import MutableMapping
+
+from heapdict import heapdict, _Transaction
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _delegate(name):
+    def method(self, *args):
+        return getattr(self.h, name)(*args)
+    method.__name__ = name
+    method.__doc__ = getattr(heapdict, name).__doc__
+    return method
+
+
+class AsyncHeapDict(MutableMapping):
+    """A heapdict whose pops can be awaited until an item arrives or is due.
+
+    Arguments other than clock are passed to heapdict() to make the heap.
+    It belongs to one event loop and is not thread-safe; BlockingHeapDict
+    shares a heap between threads. pop_due() without a now argument treats
+    priorities as times on clock, which defaults to the running loop's
+    time()."""
+
+    def _check_invariants(self):
+        self.h._check_invariants()
+
+    def __init__(self, *args, clock=None, **kw):
+        self.clock = clock
+        self.h = heapdict(*args, **kw)
+        # Futures of the pop() calls waiting for an item, oldest first, and
+        # of the pop_due() calls waiting for an earlier first item.
+        self.waiters = {}
+        self.due_waiters = {}
+
+    def _wake_one(self):
+        for future in self.waiters:
+            del self.waiters[future]
+            _wake(future)
+            return
+
+    def _wake_all(self, waiters):
+        for future in waiters:
+            _wake(future)
+        waiters.clear()
+
+    async def _wait(self, waiters, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiters[future] = None
+        timer = None if timeout is None else loop.call_later(
+            timeout, _wake, future)
+        try:
+            await future
+        finally:
+            if timer is not None:
+                timer.cancel()
+            waiters.pop(future, None)
+
+    def __setitem__(self, key, value):
+        h = self.h
+        n = len(h)
+        h[key] = value
+        if self.waiters and len(h) > n:
+            self._wake_one()
+        if self.due_waiters and h.peekitem()[0] == key:
+            self._wake_all(self.due_waiters)
+
+    __setitem__.__doc__ = dict.__setitem__.__doc__
+
+    def update(self, *args, **kw):
+        self.h.update(*args, **kw)
+        if self.h:
+            self._wake_all(self.waiters)
+            self._wake_all(self.due_waiters)
+
+    update.__doc__ = heapdict.update.__doc__
+    push_many = update
+
+    def merge(self, other, conflict=min):
+        self.h.merge(other, conflict)
+        if self.h:
+            self._wake_all(self.waiters)
+            self._wake_all(self.due_waiters)
+
+    merge.__doc__ = heapdict.merge.__doc__
+
+    def transaction(self):
+        return _Transaction(self, getattr(self.h, '_sortkey', None))
+
+    transaction.__doc__ = heapdict.transaction.__doc__
+
+    def _commit(self, values, deleted):
+        self.h._commit(values, deleted)
+        if values:
+            self._wake_all(self.waiters)
+            self._wake_all(self.due_waiters)
+
+    def copy(self):
+        other = AsyncHeapDict(clock=self.clock)
+        other.h = self.h.copy()
+        return other
+
+    copy.__doc__ = heapdict.copy.__doc__
+    __copy__ = copy
+
+    async def pop(self, *args, timeout=None):
+        """D.pop([k,[,d]], timeout=None) -> v, as heapdict.pop(), except that with no key
+it waits up to timeout seconds, or forever if timeout is None, for an item to
+arrive before raising IndexError."""
+        if args:
+            return self.h.pop(*args)
+        loop = asyncio.get_running_loop()
+        end = None if timeout is None else loop.time() + timeout
+        while not self.h:
+            remaining = None if end is None else end - loop.time()
+            if remaining is not None and remaining <= 0:
+                raise IndexError('pop(): no item arrived in time')
+            try:
+                await self._wait(self.waiters, remaining)
+            except asyncio.CancelledError:
+                # We may have been woken for an item; pass it on.
+                if self.h:
+                    self._wake_one()
+                raise
+        return self.h.popitem()[0]
+
+    async def pop_due(self, now=None, timeout=None):
+        """D.pop_due([now], timeout=None) -> (k, v), wait until the lowest value is at or
+below now, or if now is None, until clock() reaches it, then remove and return
+that (key, value) pair. An earlier item arriving is picked up straight away.
+Waits up to timeout seconds, or forever if timeout is None, and raises
+IndexError if nothing is due by then."""
+        loop = asyncio.get_running_loop()
+        clock = self.clock or loop.time
+        end = None if timeout is None else loop.time() + timeout
+        while True:
+            current = clock() if now is None else now
+            wait = None
+            if self.h:
+                value = self.h.peekitem()[1]
+                if value <= current:
+                    return self.h.popitem()
+                if now is None:
+                    wait = value - current
+            if end is not None:
+                remaining = end - loop.time()
+                if remaining <= 0:
+                    raise IndexError('pop_due(): no item was due in time')
+                wait = remaining if wait is None else min(wait, remaining)
+            await self._wait(self.due_waiters, wait)
+
+    clear = _delegate('clear')
+    __delitem__ = _delegate('__delitem__')
+    __getitem__ = _delegate('__getitem__')
+    __contains__ = _delegate('__contains__')
+    __iter__ = _delegate('__iter__')
+    __len__ = _delegate('__len__')
+    bump = heapdict.bump
+    popitem = _delegate('popitem')
+    peekitem = _delegate('peekitem')
+    popmany = _delegate('popmany')
+    nsmallest = _delegate('nsmallest')
+    iter_sorted = _delegate('iter_sorted')
+    pop_until = _delegate('pop_until')
+    count_below = _delegate('count_below')
+    items_below = _delegate('items_below')
+    items_in_range = _delegate('items_in_range')
+
+
+__all__ = ['AsyncHeapDict']
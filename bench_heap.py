@@ -0,0 +1,625 @@
+#!/usr/bin/python
+"""Benchmarks for heapdict.
+
+Runs each workload at each size against one or more heapdict
+configurations and reports throughput, per-call latency percentiles and
+peak memory:
+
+    python bench_heap.py [--sizes 1000,100000] [--workloads dijkstra,timers]
+                         [--config arity=4 --config engine=lazy]
+                         [--save results.json] [--compare baseline.json]
+
+A configuration is a comma separated list of heapdict() options, e.g.
+"engine=calendar,width=0.001"; the default configuration is "". Every run
+happens in a fresh child process so that peak memory is its own. Saving
+results and comparing a later run against them shows regressions between
+commits.
+
+With --memory it instead reports the bytes per item used by each storage,
+and with --threads 4,4 it times that many producer and consumer threads
+sharing a BlockingHeapDict and a queue.PriorityQueue. --processes 1,2,4
+times batches of updates and pops through a mpheapdict.ShardedHeapDict
+with each number of shards and through a single heapdict, to show how the
+sharded one scales with the cores available.
+
+With --trace it replays a trace recorded by heapdict.RecordingHeapDict
+against each configuration instead of running the workloads, and also
+reports the latency of each kind of operation:
+
+    python bench_heap.py --trace ops.trace --config "" --config arity=4
+"""
+from __future__ import print_function
+import argparse
+import collections
+import gc
+import gzip
+import json
+import math
+import multiprocessing
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from heapdict import heapdict, BlockingHeapDict, read_trace
+from mpheapdict import ShardedHeapDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import resource
+except ImportError:
+    resource = None
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Timed(object):
+    """A heapdict proxy that times every call made through it.
+
+    Call times are kept as a histogram of 0.1us bins for each method, so
+    that memory use stays bounded however many calls are made."""
+
+    def __init__(self, h):
+        self.h = h
+        self.histograms = collections.defaultdict(
+            lambda: collections.defaultdict(int))
+        self.seconds = 0.0
+        self.ops = 0
+
+    def record(self, elapsed, ops, name='heapdict'):
+        self.histograms[name][int(elapsed * 1e7)] += 1
+        self.seconds += elapsed
+        self.ops += ops
+
+    def _call(self, method, ops, *args):
+        start = clock()
+        try:
+            return method(*args)
+        finally:
+            self.record(clock() - start, ops, method.__name__)
+
+    def __setitem__(self, key, value):
+        self._call(self.h.__setitem__, 1, key, value)
+
+    def __getitem__(self, key):
+        return self._call(self.h.__getitem__, 1, key)
+
+    def __delitem__(self, key):
+        self._call(self.h.__delitem__, 1, key)
+
+    def __contains__(self, key):
+        return self._call(self.h.__contains__, 1, key)
+
+    def __len__(self):
+        return len(self.h)
+
+    def get(self, key, default=None):
+        return self._call(self.h.get, 1, key, default)
+
+    def popitem(self):
+        return self._call(self.h.popitem, 1)
+
+    def peekitem(self):
+        return self._call(self.h.peekitem, 1)
+
+    def update(self, items):
+        self._call(self.h.update, len(items), items)
+
+    def pop_until(self, threshold):
+        items = self._call(self.h.pop_until, 0, threshold)
+        self.ops += len(items)
+        return items
+
+
+# Each workload takes a size and a Random, builds its input data and returns
+# a function that runs the workload given a factory for timed heapdicts.
+
+def pushpop(n, r):
+    """Push n random priorities then pop them all."""
+    priorities = [r.random() for _ in range(n)]
+
+    def run(new):
+        h = new()
+        for k, p in enumerate(priorities):
+            h[k] = p
+        while h:
+            h.popitem()
+    return run
+
+
+def decrease(n, r):
+    """Fill n items, do 4*n decrease-keys, then pop them all."""
+    keys = [r.randrange(n) for _ in range(4 * n)]
+
+    def run(new):
+        h = new((k, 1.0) for k in range(n))
+        for k in keys:
+            h[k] = h[k] * 0.9
+        while h:
+            h.popitem()
+    return run
+
+
+def mixed(n, r):
+    """Start with n items, then 4*n operations: 40% inserts, 40% changes
+    of existing priorities and 20% pops."""
+    ops = [(r.random(), r.randrange(2 * n), r.random()) for _ in range(4 * n)]
+    initial = [(k, r.random()) for k in range(n)]
+
+    def run(new):
+        h = new(initial)
+        for op, k, p in ops:
+            if op < 0.4:
+                h[n + k] = p
+            elif op < 0.8:
+                if k in h:
+                    h[k] = p
+            elif h:
+                h.popitem()
+    return run
+
+
+def bulk(n, r):
+    """Load n items in ten update() batches, re-prioritising half of each."""
+    step = max(n // 10, 1)
+    batches = []
+    for start in range(0, n, step):
+        batch = dict((k, r.random()) for k in range(start, start + step))
+        batch.update((r.randrange(start + 1), r.random()) for _ in range(step // 2))
+        batches.append(batch)
+
+    def run(new):
+        h = new()
+        for batch in batches:
+            h.update(batch)
+        while h:
+            h.popitem()
+    return run
+
+
+def timers(n, r):
+    """Timer churn: n timers within a horizon of 1.0 and 5*n reschedules
+    spread over 10 ticks that each expire the due timers."""
+    initial = [(k, r.random()) for k in range(n)]
+    keys = [r.randrange(n) for _ in range(5 * n)]
+    delays = [r.random() for _ in range(5 * n)]
+
+    def run(new):
+        h = new(initial)
+        now = 0.0
+        for tick in range(10):
+            for i in range(tick * n // 2, (tick + 1) * n // 2):
+                h[keys[i]] = now + delays[i]
+            now += 0.1
+            h.pop_until(now)
+    return run
+
+
+def events(n, r):
+    """Discrete-event simulation with an integer clock: 4*n events, each
+    rescheduling itself and a random pending event to a later time."""
+    delays = [(r.randrange(1, 1000), r.randrange(n), r.randrange(1, 1000))
+              for _ in range(4 * n)]
+
+    def run(new):
+        h = new((k, k % 1000) for k in range(n))
+        for delay, other, otherdelay in delays:
+            k, now = h.popitem()
+            h[k] = now + delay
+            if other in h:
+                h[other] = now + otherdelay
+    return run
+
+
+def random_graph(n, r, degree=4):
+    # A ring, so everything is reachable, plus random edges with integer
+    # weights between 1 and 100.
+    graph = [[((u + 1) % n, r.randrange(1, 101))] for u in range(n)]
+    for _ in range((degree - 1) * n):
+        graph[r.randrange(n)].append((r.randrange(n), r.randrange(1, 101)))
+    return graph
+
+
+def dijkstra(n, r):
+    """Dijkstra's shortest paths from node 0 of a random graph with n nodes
+    and 4*n integer-weighted edges."""
+    graph = random_graph(n, r)
+
+    def run(new):
+        h = new({0: 0})
+        done = set()
+        while h:
+            u, du = h.popitem()
+            done.add(u)
+            for v, w in graph[u]:
+                if v not in done:
+                    dv = h.get(v)
+                    if dv is None or du + w < dv:
+                        h[v] = du + w
+    return run
+
+
+def astar(n, r):
+    """A* search across a square grid of about n cells with random integer
+    step costs, from one corner to the opposite one."""
+    side = max(int(math.sqrt(n)), 2)
+    cost = [r.randrange(1, 10) for _ in range(side * side)]
+    goal = side * side - 1
+
+    def heuristic(c):
+        return (side - 1 - c // side) + (side - 1 - c % side)
+
+    def run(new):
+        h = new({0: heuristic(0)})
+        g = {0: 0}
+        done = set()
+        while h:
+            u, _ = h.popitem()
+            if u == goal:
+                break
+            done.add(u)
+            row, col = divmod(u, side)
+            for v in (u - side if row else None,
+                      u + side if row < side - 1 else None,
+                      u - 1 if col else None,
+                      u + 1 if col < side - 1 else None):
+                if v is None or v in done:
+                    continue
+                gv = g[u] + cost[v]
+                if v not in g or gv < g[v]:
+                    g[v] = gv
+                    h[v] = gv + heuristic(v)
+    return run
+
+
+WORKLOADS = [pushpop, decrease, mixed, bulk, timers, events, dijkstra, astar]
+
+
+def trace(path):
+    """Return a workload replaying the trace at path, which may be gzipped.
+
+    Keys are the trace's integer ids. A del of a missing key or a pop from
+    an empty heap is timed and skipped, as ties can be broken differently
+    by the configuration that recorded the trace."""
+    def workload(n, r):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            records = list(read_trace(f))
+
+        def run(new):
+            h = new()
+            calls = {'set': h.__setitem__, 'del': h.__delitem__,
+                     'pop': h.popitem, 'peek': h.peekitem}
+            for op, key, priority in records:
+                try:
+                    if op == 'set':
+                        calls[op](key, priority)
+                    elif op == 'del':
+                        calls[op](key)
+                    else:
+                        calls[op]()
+                except (KeyError, IndexError):
+                    pass
+        return run
+    workload.__name__ = 'trace:' + path
+    return workload
+
+
+def workload_named(name):
+    if name.startswith('trace:'):
+        return trace(name[len('trace:'):])
+    return globals()[name]
+
+
+def parse_config(config):
+    """Parse "name=value,..." into a dict of heapdict() options."""
+    options = {}
+    for item in filter(None, config.split(',')):
+        name, value = item.split('=', 1)
+        for convert in (int, float):
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+        options[name] = value
+    return options
+
+
+def maxrss_kb():
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentiles(histogram, ps):
+    """Return the call times in seconds at each fraction in ps."""
+    total = sum(histogram.values())
+    result = []
+    seen = 0
+    bins = iter(sorted(histogram.items()))
+    for p in ps:
+        while seen <= p * (total - 1):
+            t, count = next(bins)
+            seen += count
+        result.append(t * 1e-7)
+    return result
+
+
+def run_one(workload, n, options):
+    """Run one workload and return its result record."""
+    run = workload(n, random.Random(n))
+    timed = []
+
+    def new(items=()):
+        start = clock()
+        h = heapdict(items, **options)
+        elapsed = clock() - start
+        h = Timed(h)
+        h.record(elapsed, len(h))
+        timed.append(h)
+        return h
+
+    gc.collect()
+    baseline = maxrss_kb()
+    start = clock()
+    run(new)
+    wall = clock() - start
+    histogram = collections.defaultdict(int)
+    by_call = collections.defaultdict(lambda: collections.defaultdict(int))
+    for h in timed:
+        for name, calls in h.histograms.items():
+            for t, count in calls.items():
+                histogram[t] += count
+                by_call[name][t] += count
+    ops = sum(h.ops for h in timed)
+    seconds = sum(h.seconds for h in timed)
+    p50, p90, p99, top = percentiles(histogram, [0.5, 0.9, 0.99, 1.0])
+    calls = {}
+    for name, calls_histogram in by_call.items():
+        calls[name] = dict(zip(
+            ['p50_us', 'p90_us', 'p99_us', 'max_us'],
+            [t * 1e6 for t in percentiles(calls_histogram,
+                                          [0.5, 0.9, 0.99, 1.0])]),
+            calls=sum(calls_histogram.values()))
+    return {
+        'ops': ops,
+        'calls': sum(histogram.values()),
+        'wall': wall,
+        'seconds': seconds,
+        'ops_per_sec': ops / seconds if seconds else 0.0,
+        'p50_us': p50 * 1e6,
+        'p90_us': p90 * 1e6,
+        'p99_us': p99 * 1e6,
+        'max_us': top * 1e6,
+        'peak_kb': maxrss_kb() - baseline,
+        'by_call': calls,
+    }
+
+
+def _child(conn, name, n, options):
+    try:
+        conn.send(run_one(workload_named(name), n, options))
+    except Exception as e:
+        conn.send({'error': '%s: %s' % (type(e).__name__, e)})
+    conn.close()
+
+
+def run_isolated(workload, n, options):
+    """Run one workload in a child process so its peak memory is its own."""
+    parent, child = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(
+        target=_child, args=(child, workload.__name__, n, options))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def record_key(record):
+    return (record['workload'], record['n'], record['config'])
+
+
+def memory_per_item(h):
+    """Return the bytes per item used by h, excluding the keys and values."""
+    seen = set(id(x) for item in h.items() for x in item)
+    total = 0
+    todo = list(vars(h).values())
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        todo.extend(gc.get_referents(obj))
+    return total / float(len(h))
+
+
+def bench_memory(sizes):
+    storages = ['list', 'compact']
+    print('{:<16}{:>10}'.format('bytes/item', 'n') +
+          ''.join('{:>10}'.format(s) for s in storages))
+    for n in sizes:
+        items = [(k, float(k)) for k in range(n)]
+        used = [memory_per_item(heapdict(items, storage=s)) for s in storages]
+        print('{:<16}{:>10}'.format('', n) +
+              ''.join('{:>10.1f}'.format(b) for b in used))
+
+
+def contention(n, producers, consumers, put, get):
+    """Return the seconds taken to pass n items from producers to consumers."""
+    def produce(p):
+        for i in range(p, n, producers):
+            put(i, random.random())
+
+    def consume(c):
+        for i in range(c, n, consumers):
+            get()
+    threads = [threading.Thread(target=produce, args=(p,))
+               for p in range(producers)]
+    threads += [threading.Thread(target=consume, args=(c,))
+                for c in range(consumers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start
+
+
+def bench_threads(sizes, producers, consumers):
+    print('{:<16}{:>10}{:>18}{:>18}'.format(
+        'items/s', 'n', 'BlockingHeapDict', 'PriorityQueue'))
+    for n in sizes:
+        h = BlockingHeapDict()
+        q = queue.PriorityQueue()
+        times = [
+            contention(n, producers, consumers, h.__setitem__,
+                       lambda: h.pop(timeout=None)),
+            contention(n, producers, consumers,
+                       lambda k, p: q.put((p, k)), q.get)]
+        print('{:<16}{:>10}'.format('', n) +
+              ''.join('{:>18.0f}'.format(n / t) for t in times))
+
+
+def scheduling_rounds(n, r):
+    # Ten rounds, each adding n/10 items due within the next two rounds.
+    step = max(n // 10, 1)
+    return [(dict(((t, k), t + 2 * r.random()) for k in range(step)), t + 1.0)
+            for t in range(10)]
+
+
+def run_rounds(h, rounds):
+    # Add each round's batch and pop the items due by its end, then pop the
+    # rest, in batches.
+    start = clock()
+    for batch, now in rounds:
+        h.update(batch)
+        h.pop_until(now)
+    h.popmany(len(h))
+    return clock() - start
+
+
+def bench_shards(sizes, counts):
+    print('{:<16}{:>10}{:>12}'.format('items/s', 'n', 'heapdict') +
+          ''.join('{:>12}'.format('shards=%d' % c) for c in counts))
+    for n in sizes:
+        rounds = scheduling_rounds(n, random.Random(n))
+        times = [run_rounds(heapdict(), rounds)]
+        for count in counts:
+            with ShardedHeapDict(shards=count) as h:
+                times.append(run_rounds(h, rounds))
+        # Each item is pushed and popped once.
+        items = 2 * sum(len(batch) for batch, _ in rounds)
+        print('{:<16}{:>10}'.format('', n) +
+              ''.join('{:>12.0f}'.format(items / t) for t in times))
+
+
+def print_calls(by_call):
+    """Print the latency percentiles of each kind of call."""
+    for name, c in sorted(by_call.items()):
+        print('{:>20}{:>10} calls  p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  '
+              'max {:.1f} us'.format(name, c['calls'], c['p50_us'], c['p90_us'],
+                                     c['p99_us'], c['max_us']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated sizes, up to 10000000')
+    parser.add_argument('--workloads', default=','.join(
+        f.__name__ for f in WORKLOADS))
+    parser.add_argument('--config', action='append',
+                        help='heapdict options to benchmark, may be repeated')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='keep the fastest of this many runs')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression')
+    parser.add_argument('--memory', action='store_true')
+    parser.add_argument('--threads', metavar='PRODUCERS,CONSUMERS',
+                        help='benchmark contention between threads')
+    parser.add_argument('--processes', metavar='SHARDS,...',
+                        help='benchmark a ShardedHeapDict with these shard counts')
+    parser.add_argument('--trace', action='append',
+                        help='replay this RecordingHeapDict trace, may be repeated')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    if args.memory:
+        return bench_memory(sizes)
+    if args.threads:
+        return bench_threads(sizes, *map(int, args.threads.split(',')))
+    if args.processes:
+        return bench_shards(sizes, [int(c) for c in args.processes.split(',')])
+    configs = args.config or ['']
+    names = args.workloads.split(',')
+    workloads = [w for w in WORKLOADS if w.__name__ in names]
+    if args.trace:
+        # A trace has its own size, so it is replayed once per configuration.
+        workloads, sizes = [trace(path) for path in args.trace], [0]
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = dict((record_key(r), r) for r in json.load(f)['results'])
+
+    print('{:<10}{:>9} {:<24}{:>12}{:>9}{:>9}{:>9}{:>9}'.format(
+        'workload', 'n', 'config', 'ops/s', 'p50 us', 'p99 us', 'peak MB',
+        'change'))
+    results = []
+    for workload in workloads:
+        if args.trace:
+            print(workload.__name__)
+        for n in sizes:
+            for config in configs:
+                options = parse_config(config)
+                runs = [run_isolated(workload, n, options)
+                        for _ in range(args.repeat)]
+                record = max(runs, key=lambda r: r.get('ops_per_sec', 0))
+                record.update(workload=workload.__name__, n=n, config=config)
+                results.append(record)
+                if args.trace:
+                    line = '{:<10}{:>9} {:<24}'.format(
+                        'trace', record.get('calls', ''), config)
+                else:
+                    line = '{:<10}{:>9} {:<24}'.format(workload.__name__, n, config)
+                if 'error' in record:
+                    print(line + record['error'])
+                    continue
+                change = ''
+                old = baseline.get(record_key(record))
+                if old and old.get('ops_per_sec'):
+                    ratio = record['ops_per_sec'] / old['ops_per_sec'] - 1
+                    change = '{:+.0%}'.format(ratio)
+                    if ratio < -args.threshold:
+                        change += ' !'
+                print(line + '{:>12.0f}{:>9.1f}{:>9.1f}{:>9.1f}{:>9}'.format(
+                    record['ops_per_sec'], record['p50_us'], record['p99_us'],
+                    record['peak_kb'] / 1024.0, change))
+                if args.trace:
+                    print_calls(record['by_call'])
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'revision': git_revision(),
+                       'python': platform.python_version(),
+                       'time': time.time(),
+                       'results': results}, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
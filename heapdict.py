@@ -1,4 +1,43 @@
-import collections
+import bisect
+import contextlib
+import gc
+import heapq
+import itertools
+import math
+import numbers
+import struct
+import threading
+import time
+import weakref
+from array import array
+from operator import itemgetter
+try:
+    # Python 2
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    # Python 3
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
+try:
+    xrange
+except NameError:
+    # Python 3
+    xrange = range
+try:
+    _integers = (int, long)
+except NameError:
+    # Python 3
+    _integers = (int,)
+# Checked in order, so the common types don't go through the ABC.
+_reals = _integers + (float, numbers.Real)
 
 
 def doc(s):
@@ -17,14 +56,14 @@ def _set(arr, i, item):
     item[2] = i
 
 
-def heappush(heap, item):
+def heappush(heap, item, arity=2):
     """Push item onto heap, maintaining the heap invariant."""
     item[2] = len(heap)
     heap.append(item)
-    _siftdown(heap, item[2])
+    _siftdown(heap, item[2], arity)
 
 
-def heappop(heap, i=0):
+def heappop(heap, i=0, arity=2):
     """Pop an item off the heap, maintaining the heap invariant."""
     returnitem = heap[i]  # raises appropriate IndexError if invalid index.
     lastelt = heap.pop()
@@ -33,32 +72,31 @@ def heappop(heap, i=0):
         _set(heap, i, lastelt)
         # if lastelt is greater than the previous node, move it down.
         if lastelt[0] > returnitem[0]:
-            _siftup(heap, i)
+            _siftup(heap, i, arity)
         # otherwise it must be equal or smaller, move it up.
         else:
-            _siftdown(heap, i)
+            _siftdown(heap, i, arity)
     return returnitem
 
 
-def heapify(heap):
+def heapify(heap, arity=2):
     """Transform list into a heap, in-place, in O(len(heap)) time."""
     # Transform bottom-up.  The largest index there's any point to looking at
-    # is the largest with a child index in-range, so must have 2*i + 1 < n,
-    # or i < (n-1)/2.  If n is even = 2*j, this is (2*j-1)/2 = j-1/2 so
-    # j-1 is the largest, which is n//2 - 1.  If n is odd = 2*j+1, this is
-    # (2*j+1-1)/2 = j so j-1 is the largest, and that's again n//2-1.
-    for i in reversed(xrange(len(heap)//2)):
-        _siftup(heap, i)
+    # is the largest with a child index in-range, so must have
+    # arity*i + 1 < n, or i <= (n-2)/arity.  For a binary heap this is the
+    # familiar n//2 - 1.
+    for i in reversed(xrange((len(heap) - 2) // arity + 1)):
+        _siftup(heap, i, arity)
 
 
 # 'heap' is a heap at all indices < pos. 'pos' is the index of a node that may
 # need to be moved up. Shift the node at pos up to restore the heap invariant.
-def _siftdown(heap, pos):
+def _siftdown(heap, pos, arity=2):
     newitem = heap[pos]
     # Follow the path to the root, moving parents down until finding a place
     # newitem fits.
     while pos > 0:
-        parentpos = (pos - 1) >> 1
+        parentpos = (pos - 1) // arity
         parent = heap[parentpos]
         if newitem[0] >= parent[0]:
             break
@@ -68,28 +106,188 @@ def _siftdown(heap, pos):
 
 # 'heap' is a heap at all indicies > pos. 'pos' is the index of a node that may
 # need to be moved down. Shift the entry at pos down to restore the heap invariant.
-def _siftup(heap, pos):
+def _siftup(heap, pos, arity=2):
     endpos = len(heap)
     newitem = heap[pos]
-    # Bubble up the smaller child until we find the right position.
-    childpos = 2 * pos + 1  # leftmost child position
+    # Bubble up the smallest child until we find the right position.
+    childpos = arity * pos + 1  # leftmost child position
     while childpos < endpos:
-        # Set childpos to index of smaller child.
-        rightpos = childpos + 1
-        if rightpos < endpos and heap[childpos][0] > heap[rightpos][0]:
-            childpos = rightpos
+        # Set childpos to index of smallest child.
+        if arity == 2:
+            rightpos = childpos + 1
+            if rightpos < endpos and heap[childpos][0] > heap[rightpos][0]:
+                childpos = rightpos
+        else:
+            for otherpos in xrange(childpos + 1, min(childpos + arity, endpos)):
+                if heap[childpos][0] > heap[otherpos][0]:
+                    childpos = otherpos
         child = heap[childpos]
         if newitem[0] <= child[0]:
             break
-        # Move the smaller child up.
+        # Move the smallest child up.
         _set(heap, pos, child)
         pos = childpos
-        childpos = 2 * pos + 1
+        childpos = arity * pos + 1
     # The node at pos is empty now, put newitem there.
     _set(heap, pos, newitem)
 
 
-class heapdict(collections.MutableMapping):
+def _rebuild_is_cheaper(k, n, arity):
+    """Return True if heapify beats k sifts to apply k changes to n items."""
+    # A sift takes at most log(n, arity) steps while heapify touches every
+    # item a couple of times. Sifts rarely go the whole way, so the constant
+    # is measured: the crossover is around k = n/3 for a million items.
+    return k * math.log(n + 1, arity) > 6 * n
+
+
+def peek(heapdicts, key=None, reverse=False):
+    """Return (i, k, v) for the item that would be popped first from any of the
+    heapdicts, where i is the index of its heapdict, looking only at the top
+    of each.  key and reverse say how the heapdicts order priorities, as for
+    heapdict().  Raises IndexError if they are all empty."""
+    best = None
+    for i, h in enumerate(heapdicts):
+        if h:
+            k, v = h.peekitem()
+            s = v if key is None else key(v)
+            if best is None or (best[0] < s if reverse else s < best[0]):
+                best = (s, i, k, v)
+    if best is None:
+        raise IndexError('peek(): every heapdict is empty')
+    return best[1:]
+
+
+# The conflict policy for merging D into E that matches merging E into D.
+_swapped = {'self': 'other', 'other': 'self'}
+
+
+def _share(sharers, h):
+    # Count h among the heapdicts sharing a heap until it is collected.
+    i = id(h)
+    sharers[i] = weakref.ref(h, lambda ref: sharers.pop(i, None))
+
+
+# dump() writes this header, then the values as an array of 8 byte ints
+# ('i') or floats ('f') in native byte order, then the keys pickled. The
+# arity is a 32 bit field; heaps any wider are written unordered.
+_SNAPSHOT = struct.Struct('=8sBcBxIQ')  # magic, version, kind, ordered, arity, n
+try:
+    array('q')
+    _INT64 = 'q'
+except ValueError:
+    # Python 2, where long is 64 bits on the platforms that matter.
+    _INT64 = 'l'
+
+
+def _tobytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _frombytes(a, data):
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+
+
+# A RecordingHeapDict trace is this magic, then one record per operation: an
+# op code, then for set and del the key's id, then for set its priority as an
+# 8 byte int or float, all little-endian.
+_TRACE_MAGIC = b'HDTRACE1'
+_TRACE_RECORDS = {
+    b'i': ('set', struct.Struct('<cIq')),
+    b'f': ('set', struct.Struct('<cId')),
+    b'd': ('del', struct.Struct('<cI')),
+    b'p': ('pop', struct.Struct('<c')),
+    b'k': ('peek', struct.Struct('<c')),
+}
+
+
+def _trace_set(i, value):
+    # Python 2's struct truncates a float packed as an int, so floats are
+    # told apart first.
+    for code in (b'f',) if isinstance(value, float) else (b'i', b'f'):
+        try:
+            return _TRACE_RECORDS[code][1].pack(code, i, value)
+        except struct.error:
+            pass
+    raise TypeError('a heapdict trace can only record int and float priorities')
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    # Allocating millions of wrappers at once sets off repeated garbage
+    # collections that find nothing to free.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _pop_implementation(h, kw):
+    # The class was already chosen by heapdict.__new__. Of the options below,
+    # those that h's class doesn't list in _options are dropped if None.
+    kw.pop('engine', None)
+    kw.pop('storage', None)
+    kw.pop('instrument', None)
+    kw.pop('key', None)
+    kw.pop('reverse', None)
+    for name in ('maxsize', 'on_evict', 'hook', 'max_garbage', 'width'):
+        if name not in h._options and kw.pop(name, None) is not None:
+            raise TypeError('%s does not support %s'
+                            % (type(h).__name__, name))
+
+
+def _pop_arity(kw):
+    # arity is the number of children per heap node. Wider heaps are
+    # shallower, making decrease-key cheaper and pops more expensive.
+    arity = kw.pop('arity', 2)
+    if arity < 2:
+        raise ValueError('arity must be at least 2')
+    return arity
+
+
+def _pop_maxsize(kw):
+    # maxsize bounds the number of items by evicting the first ones, calling
+    # on_evict(key, value) for each.
+    maxsize = kw.pop('maxsize', None)
+    if maxsize is not None and maxsize < 1:
+        raise ValueError('maxsize must be at least 1')
+    return maxsize, kw.pop('on_evict', None)
+
+
+def _pop_binary(kw, engine):
+    if _pop_arity(kw) != 2:
+        raise ValueError('the %s engine does not support arity' % engine)
+
+
+class heapdict(MutableMapping):
+
+    def __new__(cls, *args, **kw):
+        # heapdict(engine=..., storage=...) constructs the implementing class.
+        if cls is heapdict:
+            cls = _implementation(kw.get('engine'), kw.get('storage'),
+                                  kw.get('instrument') or kw.get('hook'),
+                                  kw.get('key') is not None or kw.get('reverse'))
+        return super(heapdict, cls).__new__(cls)
+
+    maxsize = on_evict = None
+    # The options of _pop_implementation() that this class takes.
+    _options = ('maxsize', 'on_evict')
+    # The index of the value in a heap wrapper.
+    _value = 0
+    # copy() lets a heapdict and its copies share one heap until one of them
+    # is changed; while they do, _sharers maps each one's id() to a weak
+    # reference to it, and every change starts by calling _own(), or for a
+    # change to one item, _own_item(). That takes private copies of the heap
+    # list and dict but goes on sharing the wrappers, copying only those the
+    # change moves; _private holds their keys and _budget is the number that
+    # may still be copied one at a time before the rest are copied at once.
+    _sharers = None
+    _private = None
 
     def _check_invariants(self):
         # the 3rd entry of each heap entry is the position in the heap
@@ -97,45 +295,493 @@ class heapdict(collections.MutableMapping):
             assert e[2] == i
         # the parent of each heap element must not be larger than the element
         for i in range(1, len(self.heap)):
-            parent = (i - 1) >> 1
+            parent = (i - 1) // self.arity
             assert self.heap[parent][0] <= self.heap[i][0]
 
     def __init__(self, *args, **kw):
+        _pop_implementation(self, kw)
+        self.arity = arity = _pop_arity(kw)
+        self.maxsize, self.on_evict = _pop_maxsize(kw)
         self.d = dict(*args, **kw)
-        self.heap = [[v, k, i] for (i, (k, v)) in enumerate(self.d.iteritems())]
+        self.heap = [[v, k, i] for (i, (k, v)) in enumerate(self.d.items())]
         self.d.update((e[1], e) for e in self.heap)
-        heapify(self.heap)
+        heapify(self.heap, arity)
+        self._trim()
 
     @doc(dict.clear)
     def clear(self):
+        if self._sharers is not None:
+            self._own(copy=False)
+            self.heap, self.d = [], {}
         del self.heap[:]
         self.d.clear()
 
     @doc(dict.__setitem__)
     def __setitem__(self, key, value):
+        if self._sharers is not None:
+            self._own_item(key)
         if key in self.d:
             wrapper = self.d[key]
             oldvalue, _, i = wrapper
             wrapper[0] = value
             if oldvalue < value:
-                _siftup(self.heap, i)
+                _siftup(self.heap, i, self.arity)
             else:
-                _siftdown(self.heap, i)
+                _siftdown(self.heap, i, self.arity)
         else:
             wrapper = [value, key, -2]
+            if self.maxsize is not None and len(self.heap) >= self.maxsize:
+                return self._push_full(wrapper)
             self.d[key] = wrapper
-            heappush(self.heap, wrapper)
+            heappush(self.heap, wrapper, self.arity)
+
+    def _push_full(self, wrapper):
+        # Add a new wrapper to a heap at maxsize, evicting the top in its
+        # place, or the new one if it would be popped first. One sift at most.
+        heap, d = self.heap, self.d
+        top = heap[0]
+        if wrapper[0] < top[0]:
+            evicted = wrapper
+        else:
+            evicted = top
+            del d[top[1]]
+            wrapper[2] = 0
+            d[wrapper[1]] = wrapper
+            heap[0] = wrapper
+            _siftup(heap, 0, self.arity)
+        if self.on_evict is not None:
+            self.on_evict(evicted[1], evicted[self._value])
+
+    def _trim(self):
+        # Evict the first items until there are no more than maxsize.
+        while self.maxsize is not None and len(self.heap) > self.maxsize:
+            key, value = self.popitem()
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+    def _heap_order(self):
+        # The keys and values in heap order, or None without an array heap.
+        heap = self.heap
+        return [e[1] for e in heap], [e[0] for e in heap]
+
+    def _restore(self, keys, values):
+        # Fill the heap from keys and values that are already in heap order.
+        with _gc_paused():
+            self.heap = list(map(list, zip(values, keys, xrange(len(keys)))))
+        self.d = dict(zip(keys, self.heap))
+
+    def copy(self):
+        """D.copy() -> a shallow copy of D, made in O(1) time.  D and its copies share one
+heap until one of them is changed.  Changing one item first copies the heap's
+list and dict of references, a fast O(len(D)) copy, and then only the O(log n)
+items the change can move, so each copy goes on sharing the items it leaves
+alone; changes to many items at once copy them all.  Reading costs nothing extra."""
+        sharers = self._sharers
+        if sharers is None:
+            sharers = self._sharers = {}
+            _share(sharers, self)
+        # The copy shares all that D holds, including wrappers D has copied.
+        self._private = None
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        _share(sharers, other)
+        return other
+
+    __copy__ = copy
+
+    def _own(self, copy=True):
+        # Stop sharing the heap, taking a private copy of it while any other
+        # sharer is alive, unless the caller is about to replace it anyway.
+        sharers = self._sharers
+        del self._sharers
+        del sharers[id(self)]
+        self._private = None
+        if sharers and copy:
+            self._unshare()
+
+    def _unshare(self):
+        # Replace the containers copy() shares with copies of them.
+        with _gc_paused():
+            self.heap = list(map(list, self.heap))
+        self.d = dict(zip([e[1] for e in self.heap], self.heap))
+
+    def _split(self):
+        # Replace the heap list and dict copy() shares with copies of them
+        # that hold the same wrappers.
+        self.heap = list(self.heap)
+        self.d = self.d.copy()
+
+    def _own_item(self, key, remove=False):
+        # Take private copies of the wrappers that setting key, or removing
+        # it if remove, can move.
+        if len(self._sharers) == 1:
+            return self._own()
+        wrapper, n = self.d.get(key), len(self.heap)
+        if wrapper is not None:
+            self._own_path(wrapper[2], n - 1 if remove else None)
+        elif not remove:
+            full = self.maxsize is not None and n >= self.maxsize
+            self._own_path(0 if full else n)
+            if self._private is not None:
+                self._private.add(key)
+
+    def _own_path(self, i, end=None):
+        # Copy the wrappers a sift from position i can move: its ancestors,
+        # and its path of smallest children among the first end positions.
+        # A pop moves the wrapper at end to i first, so that one too.
+        if self._private is None:
+            # Copying wrappers one at a time costs several times as much as
+            # copying them all at once, hence the budget of a sixteenth.
+            self._split()
+            self._private, self._budget = set(), len(self.heap) // 16
+        heap, d, private, arity = self.heap, self.d, self._private, self.arity
+        n = len(heap) if end is None else end
+        path = [] if end is None else [end]
+        j = i
+        while j > 0:
+            j = (j - 1) // arity
+            path.append(j)
+        j = i
+        while j < n:
+            path.append(j)
+            c = arity * j + 1
+            for other in xrange(c + 1, min(c + arity, n)):
+                if heap[c][0] > heap[other][0]:
+                    c = other
+            j = c
+        if len(path) > self._budget:
+            return self._own()
+        for j in path:
+            wrapper = heap[j]
+            if wrapper[1] not in private:
+                wrapper = heap[j] = list(wrapper)
+                d[wrapper[1]] = wrapper
+                private.add(wrapper[1])
+                self._budget -= 1
+
+    def __getstate__(self):
+        # Pickle the heap as flat lists in heap order rather than a list per
+        # item, so that unpickling restores it without sifting.
+        state = self.__dict__.copy()
+        del state['heap'], state['d']
+        for name in ('_sharers', '_private', '_budget'):
+            state.pop(name, None)
+        state['keys'], state['values'] = self._heap_order()
+        return state
+
+    def __setstate__(self, state):
+        keys, values = state.pop('keys'), state.pop('values')
+        self.__dict__.update(state)
+        self._restore(keys, values)
+
+    def dump(self, file):
+        """D.dump(file) -> None.  Write D to a binary file as a snapshot for load().
+
+The values must all be ints or all be floats. They are written as an array of
+8 byte numbers in heap order after a 24 byte header, so the file can be
+memory-mapped, and the keys follow it, pickled.  Ints that don't fit in 8 bytes
+are instead pickled after the keys, in a snapshot that older versions of load()
+reject."""
+        # Only a heap ordered by the values themselves can be restored as is.
+        order = self._heap_order() if self._value == 0 else None
+        if order is not None and self.arity >= 2 ** 32:
+            order = None
+        if order is None:
+            keys, values, arity = list(self), list(self.values()), 2
+        else:
+            (keys, values), arity = order, self.arity
+        try:
+            kind, numbers = b'i', array(_INT64, values)
+        except TypeError:
+            kind, numbers = b'f', array('d', values)
+        except OverflowError:
+            kind, numbers = b'p', None
+        version = 1 if numbers is not None else 2
+        file.write(_SNAPSHOT.pack(b'HEAPDICT', version, kind, order is not None,
+                                  arity, len(values)))
+        if numbers is not None:
+            file.write(_tobytes(numbers))
+        pickle.dump(keys, file, pickle.HIGHEST_PROTOCOL)
+        if numbers is None:
+            pickle.dump(values, file, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, file, **kw):
+        """heapdict.load(file, **options) -> a new heapdict from a dump() snapshot.
+
+A snapshot of an array heap is restored without sifting when the options give
+one with the same arity; otherwise its items are added with update()."""
+        header = file.read(_SNAPSHOT.size)
+        if len(header) != _SNAPSHOT.size or header[:8] != b'HEAPDICT':
+            raise ValueError('not a heapdict snapshot')
+        _, version, kind, ordered, arity, n = _SNAPSHOT.unpack(header)
+        if version not in (1, 2):
+            raise ValueError('unsupported heapdict snapshot version %d' % version)
+        if kind == b'p':
+            keys = pickle.load(file)
+            values = pickle.load(file)
+        else:
+            numbers = array(_INT64 if kind == b'i' else 'd')
+            _frombytes(numbers, file.read(n * numbers.itemsize))
+            keys = pickle.load(file)
+            values = numbers.tolist()
+        h = cls(**kw)
+        if (ordered and h._value == 0 and h._heap_order() == ([], [])
+                and h.arity == arity):
+            h._restore(keys, values)
+            h._trim()
+        else:
+            h.update(zip(keys, values))
+        return h
+
+    def bump(self, key, amount=1, default=None):
+        """D.bump(k[,amount[,d]]) -> D[k] + amount, which is also stored in D[k], or d
+if k is not in D.  Counting uses with bump() turns a heapdict with maxsize into
+an LFU cache."""
+        if key not in self:
+            return default
+        value = self[key] + amount
+        self[key] = value
+        return value
+
+    def update(self, *args, **kw):
+        """D.update([E, ]**F) -> None.  Update D from dict/iterable E and F.
+
+Large batches are applied by updating the items in place and rebuilding the
+heap in O(len(D)) time instead of sifting each item into place."""
+        items = dict(*args, **kw)
+        if not _rebuild_is_cheaper(len(items), len(self) + len(items), self.arity):
+            for key, value in items.items():
+                self[key] = value
+            return
+        if self._sharers is not None:
+            self._own()
+        heap, d = self.heap, self.d
+        for key, value in items.items():
+            if key in d:
+                d[key][0] = value
+            else:
+                wrapper = [value, key, len(heap)]
+                d[key] = wrapper
+                heap.append(wrapper)
+        heapify(heap, self.arity)
+        self._trim()
+
+    push_many = update
+
+    def merge(self, other, conflict=min):
+        """D.merge(E, conflict=min) -> None.  Add the items of the mapping E, such as
+another heapdict, to D, leaving E unchanged.  A key in both gets the value
+conflict(D[k], E[k]), or keeps D[k] if conflict is 'self' and takes E[k] if it
+is 'other'.  If E is a larger heapdict of the same kind, D takes a copy of its
+heap as it stands and adds its own items to that, so that the cost depends on
+the smaller of the two; large batches are added by rebuilding the heap."""
+        if not (callable(conflict) or conflict in ('self', 'other')):
+            raise ValueError("conflict must be callable, 'self' or 'other'")
+        order = other._heap_order() if isinstance(other, heapdict) else None
+        if (order is not None and type(other) is type(self) and self._value == 0
+                and other.arity == self.arity and len(other) > len(self)):
+            # Swap roles: D's items are merged into a copy of E's heap.
+            if callable(conflict):
+                swapped = lambda mine, theirs: conflict(theirs, mine)
+            else:
+                swapped = _swapped[conflict]
+            keys, values = self._heap_order()
+            if self._sharers is not None:
+                self._own(copy=False)
+            self._restore(*order)
+            self._merge(zip(keys, values), swapped)
+            self._trim()
+        else:
+            # Read an array heap's lists rather than look up each key.
+            self._merge(other.items() if order is None else zip(*order), conflict)
+
+    def _merge(self, pairs, conflict):
+        # Add pairs to the heap, settling keys already in it by conflict.
+        if conflict == 'other':
+            items = dict(pairs)
+        elif conflict == 'self':
+            items = dict((k, v) for (k, v) in pairs if k not in self)
+        else:
+            items = {}
+            for key, value in pairs:
+                if key in self:
+                    value = conflict(self[key], value)
+                items[key] = value
+        self.update(items)
+
+    def popmany(self, n):
+        """D.popmany(n) -> list of up to n (key, value) pairs with the lowest values,
+removed from D and returned in increasing value order."""
+        heap, d, arity = self.heap, self.d, self.arity
+        if n >= len(heap):
+            items = [(e[1], e[0]) for e in sorted(heap, key=itemgetter(0))]
+            self.clear()
+            return items
+        if self._sharers is not None:
+            return [self.popitem() for _ in xrange(n)]
+        items = []
+        for _ in xrange(n):
+            wrapper = heappop(heap, 0, arity)
+            del d[wrapper[1]]
+            items.append((wrapper[1], wrapper[0]))
+        return items
+
+    def nsmallest(self, n):
+        """D.nsmallest(n) -> list of up to n (key, value) pairs with the lowest values,
+in increasing value order, without removing them from D."""
+        heap, arity = self.heap, self.arity
+        items = []
+        # Only the top of the heap is searched, using a frontier heap of the
+        # children of the items found so far.
+        frontier = [(heap[0][0], 0)] if heap and n > 0 else []
+        while frontier:
+            value, i = heapq.heappop(frontier)
+            items.append((heap[i][1], value))
+            if len(items) == n:
+                break
+            child = arity * i + 1
+            for c in xrange(child, min(child + arity, len(heap))):
+                heapq.heappush(frontier, (heap[c][0], c))
+        return items
+
+    def iter_sorted(self):
+        """D.iter_sorted() -> an iterator over the (key, value) pairs in increasing value
+order, leaving D unchanged.  The first k pairs cost O(k log k).  Raises
+RuntimeError if D changes size, or if a change that would spoil the order is
+found, during iteration."""
+        heap, arity, v = self.heap, self.arity, self._value
+        n = len(heap)
+        # As in nsmallest, but the frontier also holds each wrapper so that
+        # one moved or changed since it was reached can be detected.
+        frontier = [(heap[0][0], 0, heap[0])] if heap else []
+        while frontier:
+            value, i, wrapper = heapq.heappop(frontier)
+            if (len(heap) != n or self.heap is not heap or heap[i] is not wrapper
+                    or wrapper[0] is not value):
+                raise RuntimeError('heapdict changed during iteration')
+            # Reach the children before yielding, so that every frontier
+            # entry is checked against the heap as it stands when popped.
+            child = arity * i + 1
+            for c in xrange(child, min(child + arity, len(heap))):
+                heapq.heappush(frontier, (heap[c][0], c, heap[c]))
+            yield (wrapper[1], wrapper[v])
+
+    def _until(self, threshold):
+        # Return the wrappers at or below threshold, in heap order, skipping
+        # subtrees whose root is above threshold.
+        heap, arity = self.heap, self.arity
+        found = []
+        todo = [0] if heap and heap[0][0] <= threshold else []
+        while todo:
+            i = todo.pop()
+            found.append(heap[i])
+            child = arity * i + 1
+            for c in xrange(child, min(child + arity, len(heap))):
+                if heap[c][0] <= threshold:
+                    todo.append(c)
+        return found
+
+    def _drop(self, found):
+        # Remove the found wrappers and rebuild the heap from what remains.
+        # They must be this heapdict's own, so the caller owns the heap first.
+        heap, d = self.heap, self.d
+        for wrapper in found:
+            wrapper[2] = -1
+            del d[wrapper[1]]
+        heap[:] = [e for e in heap if e[2] >= 0]
+        for i, e in enumerate(heap):
+            e[2] = i
+        heapify(heap, self.arity)
+        found.sort(key=itemgetter(0))
+
+    def pop_until(self, threshold):
+        """D.pop_until(threshold) -> list of all (key, value) pairs with values at or
+below threshold, removed from D and returned in increasing value order."""
+        found = self._until(threshold)
+        if not _rebuild_is_cheaper(len(found), len(self.heap), self.arity):
+            return [self.popitem() for _ in found]
+        if self._sharers is not None:
+            # Find the wrappers again in the private copy.
+            self._own()
+            found = self._until(threshold)
+        self._drop(found)
+        return [(e[1], e[0]) for e in found]
+
+    def _below(self, bound, start=None):
+        # Return the wrappers below bound and, unless start is None, not
+        # below start, skipping subtrees whose root is not below bound.
+        heap, arity = self.heap, self.arity
+        found = []
+        todo = [0] if heap and heap[0][0] < bound else []
+        while todo:
+            i = todo.pop()
+            found.append(heap[i])
+            child = arity * i + 1
+            for c in xrange(child, min(child + arity, len(heap))):
+                if heap[c][0] < bound:
+                    todo.append(c)
+        if start is not None:
+            found = [e for e in found if not e[0] < start]
+        return found
+
+    def _items(self, found):
+        # Return the (key, value) pairs of what _below() found, in order.
+        v = self._value
+        found.sort(key=itemgetter(0))
+        return [(e[1], e[v]) for e in found]
+
+    def count_below(self, x):
+        """D.count_below(x) -> the number of values in D below x.  Subtrees of the heap
+whose root is not below x are skipped, so this costs O(k) for a count of k."""
+        return len(self._below(x))
+
+    def items_below(self, x):
+        """D.items_below(x) -> list of the (key, value) pairs with values below x, in
+increasing value order, leaving D unchanged.  This costs O(k log k) for k pairs."""
+        return self._items(self._below(x))
+
+    def items_in_range(self, a, b):
+        """D.items_in_range(a, b) -> list of the (key, value) pairs with values from a up
+to but not including b, in increasing value order, leaving D unchanged.  The heap
+is searched as for items_below(b), so this costs O(k log k) for the k values
+below b."""
+        return self._items(self._below(b, a))
+
+    def transaction(self):
+        """D.transaction() -> a context manager for a batch of changes to D that can be
+rolled back.  Changes made through it are kept aside, each replacing any earlier
+change to the same key, and reads through it see D with the changes made, while
+D itself is left alone until the changes are committed: each changed key is then
+set once, with update(), which rebuilds the heap for large batches.  Leaving the
+with block commits the changes, unless it raised, which rolls them back.
+rollback() discards the changes made so far and commit() applies them early."""
+        return _Transaction(self, getattr(self, '_sortkey', None))
+
+    def _commit(self, values, deleted):
+        # Apply a transaction's changes. A deleted key may since have been
+        # removed from D directly.
+        for key in deleted:
+            if key in self:
+                del self[key]
+        self.update(values)
 
     @doc(dict.__delitem__)
     def __delitem__(self, key):
+        if self._sharers is not None:
+            self._own_item(key, remove=True)
         i = self.d[key][2]
-        heappop(self.heap, i)
+        heappop(self.heap, i, self.arity)
         del self.d[key]
 
     @doc(dict.__getitem__)
     def __getitem__(self, key):
         return self.d[key][0]
 
+    @doc(dict.__contains__)
+    def __contains__(self, key):
+        return key in self.d
+
     @doc(dict.__iter__)
     def __iter__(self):
         return iter(self.d)
@@ -157,7 +803,9 @@ d is returned if given, otherwise KeyError is raised"""
 
     def popitem(self):
         """D.popitem() -> (k, v), remove and return the (key, value) pair with lowest\nvalue; but raise KeyError if D is empty."""
-        wrapper = heappop(self.heap)
+        if self._sharers is not None and self.heap:
+            self._own_item(self.heap[0][1], remove=True)
+        wrapper = heappop(self.heap, 0, self.arity)
         del self.d[wrapper[1]]
         return (wrapper[1], wrapper[0])
 
@@ -167,5 +815,2692 @@ d is returned if given, otherwise KeyError is raised"""
         return (wrapper[1], wrapper[0])
 
 
+class CompactHeapDict(heapdict):
+    """A heapdict that stores keys and values in parallel heap-ordered lists.
+
+    Rather than a [value, key, index] list per item, self.heapkeys and
+    self.heapvalues hold the heap, and self.d maps each key to its position.
+    This saves the per-item list at the cost of a dict store for every heap
+    move. Use heapdict(storage='compact') to construct one."""
+
+    _options = ()
+
+    def _check_invariants(self):
+        keys, values = self.heapkeys, self.heapvalues
+        assert len(keys) == len(values) == len(self.d)
+        for i, k in enumerate(keys):
+            assert self.d[k] == i
+        for i in range(1, len(values)):
+            parent = (i - 1) // self.arity
+            assert values[parent] <= values[i]
+
+    def __init__(self, *args, **kw):
+        _pop_implementation(self, kw)
+        self.arity = _pop_arity(kw)
+        self.d = dict(*args, **kw)
+        self.heapkeys = list(self.d)
+        self.heapvalues = [self.d[k] for k in self.heapkeys]
+        self.d.update((k, i) for (i, k) in enumerate(self.heapkeys))
+        self._heapify()
+
+    def _heap_order(self):
+        return self.heapkeys, self.heapvalues
+
+    def _restore(self, keys, values):
+        self.heapkeys, self.heapvalues = list(keys), list(values)
+        self.d = dict(zip(keys, xrange(len(keys))))
+
+    def _unshare(self):
+        self.heapkeys, self.heapvalues = list(self.heapkeys), list(self.heapvalues)
+        self.d = dict(self.d)
+
+    def __getstate__(self):
+        # The heap lists are already flat; only the positions are rebuilt.
+        state = self.__dict__.copy()
+        del state['d']
+        state.pop('_sharers', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._restore(self.heapkeys, self.heapvalues)
+
+    def _heapify(self):
+        for i in reversed(xrange((len(self.heapkeys) - 2) // self.arity + 1)):
+            self._siftup(i)
+
+    def _siftdown(self, pos):
+        keys, values, d, arity = self.heapkeys, self.heapvalues, self.d, self.arity
+        newkey, newvalue = keys[pos], values[pos]
+        while pos > 0:
+            parentpos = (pos - 1) // arity
+            parentvalue = values[parentpos]
+            if newvalue >= parentvalue:
+                break
+            parentkey = keys[parentpos]
+            keys[pos], values[pos], d[parentkey] = parentkey, parentvalue, pos
+            pos = parentpos
+        keys[pos], values[pos], d[newkey] = newkey, newvalue, pos
+
+    def _siftup(self, pos):
+        keys, values, d, arity = self.heapkeys, self.heapvalues, self.d, self.arity
+        endpos = len(values)
+        newkey, newvalue = keys[pos], values[pos]
+        childpos = arity * pos + 1
+        while childpos < endpos:
+            for otherpos in xrange(childpos + 1, min(childpos + arity, endpos)):
+                if values[childpos] > values[otherpos]:
+                    childpos = otherpos
+            childvalue = values[childpos]
+            if newvalue <= childvalue:
+                break
+            childkey = keys[childpos]
+            keys[pos], values[pos], d[childkey] = childkey, childvalue, pos
+            pos = childpos
+            childpos = arity * pos + 1
+        keys[pos], values[pos], d[newkey] = newkey, newvalue, pos
+
+    def _remove(self, i):
+        # Remove the item at heap position i and return its (key, value).
+        if self._sharers is not None:
+            self._own()
+        keys, values = self.heapkeys, self.heapvalues
+        key, value = keys[i], values[i]  # raises IndexError if empty.
+        lastkey, lastvalue = keys.pop(), values.pop()
+        del self.d[key]
+        if i < len(keys):
+            keys[i], values[i], self.d[lastkey] = lastkey, lastvalue, i
+            if lastvalue > value:
+                self._siftup(i)
+            else:
+                self._siftdown(i)
+        return key, value
+
+    @doc(dict.clear)
+    def clear(self):
+        if self._sharers is not None:
+            self._own(copy=False)
+            self.heapkeys, self.heapvalues, self.d = [], [], {}
+        del self.heapkeys[:]
+        del self.heapvalues[:]
+        self.d.clear()
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        if self._sharers is not None:
+            self._own()
+        if key in self.d:
+            i = self.d[key]
+            oldvalue = self.heapvalues[i]
+            self.heapvalues[i] = value
+            if oldvalue < value:
+                self._siftup(i)
+            else:
+                self._siftdown(i)
+        else:
+            self.d[key] = i = len(self.heapkeys)
+            self.heapkeys.append(key)
+            self.heapvalues.append(value)
+            self._siftdown(i)
+
+    @doc(heapdict.update)
+    def update(self, *args, **kw):
+        items = dict(*args, **kw)
+        if self._sharers is not None:
+            self._own()
+        keys, values, d = self.heapkeys, self.heapvalues, self.d
+        if not _rebuild_is_cheaper(len(items), len(keys) + len(items), self.arity):
+            for key, value in items.items():
+                self[key] = value
+            return
+        for key, value in items.items():
+            if key in d:
+                values[d[key]] = value
+            else:
+                d[key] = len(keys)
+                keys.append(key)
+                values.append(value)
+        self._heapify()
+
+    push_many = update
+
+    @doc(heapdict.popmany)
+    def popmany(self, n):
+        keys, values = self.heapkeys, self.heapvalues
+        if n >= len(keys):
+            order = sorted(xrange(len(keys)), key=values.__getitem__)
+            items = [(keys[i], values[i]) for i in order]
+            self.clear()
+            return items
+        return [self._remove(0) for _ in xrange(n)]
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        keys, values, arity = self.heapkeys, self.heapvalues, self.arity
+        items = []
+        frontier = [(values[0], 0)] if values and n > 0 else []
+        while frontier:
+            value, i = heapq.heappop(frontier)
+            items.append((keys[i], value))
+            if len(items) == n:
+                break
+            child = arity * i + 1
+            for c in xrange(child, min(child + arity, len(values))):
+                heapq.heappush(frontier, (values[c], c))
+        return items
+
+    @doc(heapdict.iter_sorted)
+    def iter_sorted(self):
+        keys, values, arity = self.heapkeys, self.heapvalues, self.arity
+        n = len(values)
+        frontier = [(values[0], 0, keys[0])] if values else []
+        while frontier:
+            value, i, key = heapq.heappop(frontier)
+            if (len(values) != n or self.heapkeys is not keys or keys[i] is not key
+                    or values[i] is not value):
+                raise RuntimeError('heapdict changed during iteration')
+            child = arity * i + 1
+            for c in xrange(child, min(child + arity, len(values))):
+                heapq.heappush(frontier, (values[c], c, keys[c]))
+            yield (key, value)
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        if self._sharers is not None:
+            self._own()
+        keys, values, d, arity = self.heapkeys, self.heapvalues, self.d, self.arity
+        found = []
+        todo = [0] if values and values[0] <= threshold else []
+        while todo:
+            i = todo.pop()
+            found.append(i)
+            child = arity * i + 1
+            for c in xrange(child, min(child + arity, len(values))):
+                if values[c] <= threshold:
+                    todo.append(c)
+        if not _rebuild_is_cheaper(len(found), len(values), arity):
+            return [self._remove(0) for _ in found]
+        found.sort(key=values.__getitem__)
+        items = [(keys[i], values[i]) for i in found]
+        for key, _ in items:
+            del d[key]
+        kept = [i for i in xrange(len(keys)) if keys[i] in d]
+        keys[:] = [keys[i] for i in kept]
+        values[:] = [values[i] for i in kept]
+        for i, key in enumerate(keys):
+            d[key] = i
+        self._heapify()
+        return items
+
+    def _below(self, bound, start=None):
+        # As heapdict._below, but returning heap positions.
+        values, arity = self.heapvalues, self.arity
+        found = []
+        todo = [0] if values and values[0] < bound else []
+        while todo:
+            i = todo.pop()
+            found.append(i)
+            child = arity * i + 1
+            for c in xrange(child, min(child + arity, len(values))):
+                if values[c] < bound:
+                    todo.append(c)
+        if start is not None:
+            found = [i for i in found if not values[i] < start]
+        return found
+
+    def _items(self, found):
+        keys, values = self.heapkeys, self.heapvalues
+        found.sort(key=values.__getitem__)
+        return [(keys[i], values[i]) for i in found]
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        self._remove(self.d[key])
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return self.heapvalues[self.d[key]]
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        return self._remove(0)
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        return (self.heapkeys[0], self.heapvalues[0])
+
+
+class InstrumentedHeapDict(heapdict):
+    """A heapdict that counts what its operations cost.
+
+    stats() returns the number of pushes, pops, increases, decreases and
+    deletes, and of the sift steps and priority comparisons they took. If
+    hook is given it is called as hook(op, key, value, steps) after each of
+    those operations. The sifts are reimplemented here with counters so that
+    a plain heapdict pays nothing for them, and the batch methods apply one
+    item at a time so that every change is counted. Use
+    heapdict(instrument=True) or heapdict(hook=f) to construct one."""
+
+    _options = ('hook',)
+
+    def __init__(self, *args, **kw):
+        self.hook = kw.pop('hook', None)
+        self.reset_stats()
+        super(InstrumentedHeapDict, self).__init__(*args, **kw)
+
+    def stats(self):
+        """D.stats() -> dict of operation counts since D was created or reset."""
+        return dict(self.counts)
+
+    def _unshare(self):
+        super(InstrumentedHeapDict, self)._unshare()
+        self.counts = dict(self.counts)
+
+    def _split(self):
+        super(InstrumentedHeapDict, self)._split()
+        self.counts = dict(self.counts)
+
+    def reset_stats(self):
+        """D.reset_stats() -> None.  Set all the operation counts to zero."""
+        self.counts = dict.fromkeys(['push', 'pop', 'increase', 'decrease',
+                                     'delete', 'sift_steps', 'comparisons'], 0)
+
+    def _siftdown(self, pos):
+        heap, arity = self.heap, self.arity
+        newitem = heap[pos]
+        steps = comparisons = 0
+        while pos > 0:
+            parentpos = (pos - 1) // arity
+            parent = heap[parentpos]
+            comparisons += 1
+            if newitem[0] >= parent[0]:
+                break
+            _set(heap, pos, parent)
+            pos = parentpos
+            steps += 1
+        _set(heap, pos, newitem)
+        self.counts['comparisons'] += comparisons
+        self.counts['sift_steps'] += steps
+        return steps
+
+    def _siftup(self, pos):
+        heap, arity = self.heap, self.arity
+        endpos = len(heap)
+        newitem = heap[pos]
+        steps = comparisons = 0
+        childpos = arity * pos + 1
+        while childpos < endpos:
+            for otherpos in xrange(childpos + 1, min(childpos + arity, endpos)):
+                comparisons += 1
+                if heap[childpos][0] > heap[otherpos][0]:
+                    childpos = otherpos
+            child = heap[childpos]
+            comparisons += 1
+            if newitem[0] <= child[0]:
+                break
+            _set(heap, pos, child)
+            pos = childpos
+            childpos = arity * pos + 1
+            steps += 1
+        _set(heap, pos, newitem)
+        self.counts['comparisons'] += comparisons
+        self.counts['sift_steps'] += steps
+        return steps
+
+    def _remove(self, i, op):
+        if self._sharers is not None and i < len(self.heap):
+            self._own_item(self.heap[i][1], remove=True)
+        heap = self.heap
+        wrapper = heap[i]  # raises IndexError if empty.
+        lastelt = heap.pop()
+        steps = 0
+        if lastelt is not wrapper:
+            _set(heap, i, lastelt)
+            self.counts['comparisons'] += 1
+            if lastelt[0] > wrapper[0]:
+                steps = self._siftup(i)
+            else:
+                steps = self._siftdown(i)
+        del self.d[wrapper[1]]
+        self._count(op, wrapper[1], wrapper[0], steps)
+        return wrapper
+
+    def _count(self, op, key, value, steps):
+        self.counts[op] += 1
+        if self.hook is not None:
+            self.hook(op, key, value, steps)
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        if self._sharers is not None:
+            self._own_item(key)
+        wrapper = self.d.get(key)
+        if wrapper is None:
+            wrapper = [value, key, len(self.heap)]
+            self.d[key] = wrapper
+            self.heap.append(wrapper)
+            op, steps = 'push', self._siftdown(wrapper[2])
+        else:
+            oldvalue = wrapper[0]
+            wrapper[0] = value
+            self.counts['comparisons'] += 1
+            if oldvalue < value:
+                op, steps = 'increase', self._siftup(wrapper[2])
+            else:
+                op, steps = 'decrease', self._siftdown(wrapper[2])
+        self._count(op, key, value, steps)
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        self._remove(self.d[key][2], 'delete')
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        wrapper = self._remove(0, 'pop')
+        return (wrapper[1], wrapper[0])
+
+    @doc(heapdict.update)
+    def update(self, *args, **kw):
+        for key, value in dict(*args, **kw).items():
+            self[key] = value
+
+    push_many = update
+
+    @doc(heapdict.popmany)
+    def popmany(self, n):
+        return [self.popitem() for _ in xrange(min(n, len(self.heap)))]
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        items = []
+        while self.heap and self.heap[0][0] <= threshold:
+            items.append(self.popitem())
+        return items
+
+
+class _Reversed(object):
+    """Wraps a sort key so that it orders in reverse.
+
+    Only used for sort keys that aren't real numbers, which are negated."""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __le__(self, other):
+        return other.key <= self.key
+
+    def __gt__(self, other):
+        return other.key > self.key
+
+    def __ge__(self, other):
+        return other.key >= self.key
+
+
+class KeyedHeapDict(heapdict):
+    """A heapdict ordered by key(value) rather than by the values themselves.
+
+    As with sorted(), the key function is called once each time a value is
+    set, and sifting only compares the resulting sort keys, which are kept
+    in [sortkey, key, index, value] wrappers. With reverse=True the largest
+    comes first, so a max-heap needs no negated priorities; real sort keys
+    are negated here instead, and others wrapped in _Reversed. pop_until pops
+    the items ordered at or before its threshold, while the range queries
+    compare the values themselves and so check every item. Use
+    heapdict(key=f) or heapdict(reverse=True) to construct one."""
+
+    _value = 3
+
+    def __init__(self, *args, **kw):
+        self.key = kw.pop('key', None)
+        self.reverse = kw.pop('reverse', False)
+        _pop_implementation(self, kw)
+        self.arity = arity = _pop_arity(kw)
+        self.maxsize, self.on_evict = _pop_maxsize(kw)
+        self.d = dict(*args, **kw)
+        sortkey = self._sortkey
+        self.heap = [[sortkey(v), k, i, v]
+                     for (i, (k, v)) in enumerate(self.d.items())]
+        self.d.update((e[1], e) for e in self.heap)
+        heapify(self.heap, arity)
+        self._trim()
+
+    def _heap_order(self):
+        heap = self.heap
+        return [e[1] for e in heap], [e[3] for e in heap]
+
+    def _restore(self, keys, values):
+        # The sort keys are recomputed rather than stored, so the key
+        # function is called once per item.
+        sortkey = self._sortkey
+        with _gc_paused():
+            self.heap = [[sortkey(v), k, i, v]
+                         for (i, (k, v)) in enumerate(zip(keys, values))]
+        self.d = dict(zip(keys, self.heap))
+
+    def _sortkey(self, value):
+        if self.key is not None:
+            value = self.key(value)
+        if not self.reverse:
+            return value
+        return -value if isinstance(value, _reals) else _Reversed(value)
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        if self._sharers is not None:
+            self._own_item(key)
+        sortkey = self._sortkey(value)
+        wrapper = self.d.get(key)
+        if wrapper is None:
+            wrapper = [sortkey, key, -2, value]
+            if self.maxsize is not None and len(self.heap) >= self.maxsize:
+                return self._push_full(wrapper)
+            self.d[key] = wrapper
+            heappush(self.heap, wrapper, self.arity)
+        else:
+            oldkey = wrapper[0]
+            wrapper[0], wrapper[3] = sortkey, value
+            if oldkey < sortkey:
+                _siftup(self.heap, wrapper[2], self.arity)
+            else:
+                _siftdown(self.heap, wrapper[2], self.arity)
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return self.d[key][3]
+
+    @doc(heapdict.update)
+    def update(self, *args, **kw):
+        items = dict(*args, **kw)
+        if not _rebuild_is_cheaper(len(items), len(self) + len(items), self.arity):
+            for key, value in items.items():
+                self[key] = value
+            return
+        if self._sharers is not None:
+            self._own()
+        heap, d, sortkey = self.heap, self.d, self._sortkey
+        for key, value in items.items():
+            if key in d:
+                d[key][0], d[key][3] = sortkey(value), value
+            else:
+                wrapper = [sortkey(value), key, len(heap), value]
+                d[key] = wrapper
+                heap.append(wrapper)
+        heapify(heap, self.arity)
+        self._trim()
+
+    push_many = update
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        if self._sharers is not None and self.heap:
+            self._own_item(self.heap[0][1], remove=True)
+        wrapper = heappop(self.heap, 0, self.arity)
+        del self.d[wrapper[1]]
+        return (wrapper[1], wrapper[3])
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        wrapper = self.heap[0]
+        return (wrapper[1], wrapper[3])
+
+    @doc(heapdict.popmany)
+    def popmany(self, n):
+        if n >= len(self.heap):
+            items = [(e[1], e[3]) for e in sorted(self.heap, key=itemgetter(0))]
+            self.clear()
+            return items
+        return [self.popitem() for _ in xrange(n)]
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        heap, arity = self.heap, self.arity
+        items = []
+        frontier = [(heap[0][0], 0)] if heap and n > 0 else []
+        while frontier:
+            _, i = heapq.heappop(frontier)
+            items.append((heap[i][1], heap[i][3]))
+            if len(items) == n:
+                break
+            child = arity * i + 1
+            for c in xrange(child, min(child + arity, len(heap))):
+                heapq.heappush(frontier, (heap[c][0], c))
+        return items
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        found = self._until(self._sortkey(threshold))
+        if not _rebuild_is_cheaper(len(found), len(self.heap), self.arity):
+            return [self.popitem() for _ in found]
+        if self._sharers is not None:
+            self._own()
+            found = self._until(self._sortkey(threshold))
+        self._drop(found)
+        return [(e[1], e[3]) for e in found]
+
+    def _below(self, bound, start=None):
+        # The bounds compare with the values themselves, which the heap is
+        # not ordered by, so there are no subtrees to skip.
+        return [e for e in self.heap
+                if e[3] < bound and (start is None or not e[3] < start)]
+
+    def _items(self, found):
+        found.sort(key=itemgetter(3))
+        return [(e[1], e[3]) for e in found]
+
+
+# Marks a key deleted in a transaction.
+_deleted = object()
+
+
+class _Transaction(MutableMapping):
+    # What heapdict.transaction() returns: a view of the heapdict h with the
+    # changes in self.changes, which maps each changed key to its new value
+    # or to _deleted. sortkey, if not None, orders values as h does.
+
+    def __init__(self, h, sortkey=None):
+        self.h = h
+        self.sortkey = sortkey
+        self.changes = {}
+        # The changed items in order, kept until the next change.
+        self.ordered = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def commit(self):
+        """T.commit() -> None.  Apply the changes to the heapdict and start afresh."""
+        values = self.changes
+        deleted = [key for key, value in values.items() if value is _deleted]
+        for key in deleted:
+            del values[key]
+        self.changes, self.ordered = {}, None
+        self.h._commit(values, deleted)
+
+    def rollback(self):
+        """T.rollback() -> None.  Discard the changes that have not been committed."""
+        self.changes, self.ordered = {}, None
+
+    def _order(self):
+        sortkey = self.sortkey
+        return itemgetter(1) if sortkey is None else lambda item: sortkey(item[1])
+
+    def _changed(self):
+        if self.ordered is None:
+            self.ordered = sorted(
+                (item for item in self.changes.items() if item[1] is not _deleted),
+                key=self._order())
+        return self.ordered
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+        self.ordered = None
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.h:
+            self.changes[key] = _deleted
+        else:
+            del self.changes[key]
+        self.ordered = None
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        changes = self.changes
+        if key not in changes:
+            return self.h[key]
+        value = changes[key]
+        if value is _deleted:
+            raise KeyError(key)
+        return value
+
+    @doc(dict.__contains__)
+    def __contains__(self, key):
+        changes = self.changes
+        if key in changes:
+            return changes[key] is not _deleted
+        return key in self.h
+
+    @doc(dict.__iter__)
+    def __iter__(self):
+        changes = self.changes
+        for key in self.h:
+            if key not in changes:
+                yield key
+        for key, value in changes.items():
+            if value is not _deleted:
+                yield key
+
+    @doc(dict.__len__)
+    def __len__(self):
+        n, h = len(self.h), self.h
+        for key, value in self.changes.items():
+            if value is _deleted:
+                n -= 1
+            elif key not in h:
+                n += 1
+        return n
+
+    def iter_sorted(self):
+        """T.iter_sorted() -> an iterator over the (key, value) pairs in increasing value
+order, merging the heapdict's iter_sorted() with the changed items."""
+        changes, changed, order = self.changes, self._changed(), self._order()
+        i = 0
+        for item in self.h.iter_sorted():
+            if item[0] in changes:
+                continue
+            while i < len(changed) and order(changed[i]) < order(item):
+                yield changed[i]
+                i += 1
+            yield item
+        for item in changed[i:]:
+            yield item
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        for item in self.iter_sorted():
+            return item
+        raise IndexError('peekitem(): heapdict is empty')
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        for item in self.iter_sorted():
+            break
+        else:
+            raise IndexError('popitem(): heapdict is empty')
+        del self[item[0]]
+        return item
+
+    @doc(heapdict.pop)
+    def pop(self, *args):
+        if not args:
+            return self.popitem()[0]
+        return super(_Transaction, self).pop(*args)
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        return list(itertools.islice(self.iter_sorted(), max(n, 0)))
+
+
+class _Engine(heapdict):
+    """Base class for heapdict engines that don't use the array heap.
+
+    Subclasses provide the mapping methods, popitem, peekitem, nsmallest,
+    _below and _check_invariants; the batch methods here are built on
+    those."""
+
+    _options = ()
+
+    def _heap_order(self):
+        return None
+
+    def __getstate__(self):
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def copy(self):
+        """D.copy() -> a shallow copy of D, made in O(len(D)) time.  Only the array heaps
+share structure between copies."""
+        other = self.__class__.__new__(self.__class__)
+        other.__setstate__(self.__getstate__())
+        other._unshare()
+        return other
+
+    __copy__ = copy
+
+    def _unshare(self):
+        # Engines whose __setstate__ shares containers with the state copy
+        # them here.
+        pass
+
+    @doc(heapdict.update)
+    def update(self, *args, **kw):
+        for key, value in dict(*args, **kw).items():
+            self[key] = value
+
+    push_many = update
+
+    @doc(heapdict.popmany)
+    def popmany(self, n):
+        return [self.popitem() for _ in xrange(min(n, len(self)))]
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        items = []
+        while self and self.peekitem()[1] <= threshold:
+            items.append(self.popitem())
+        return items
+
+    def _items(self, found):
+        # The engines' _below() already returns sorted (key, value) pairs.
+        return found
+
+    @doc(heapdict.iter_sorted)
+    def iter_sorted(self):
+        # Take prefixes of doubling length from nsmallest, checking that
+        # each starts with the pairs already yielded.
+        n, done, k = len(self), [], 16
+        while True:
+            items = self.nsmallest(k)
+            if len(self) != n or items[:len(done)] != done:
+                raise RuntimeError('heapdict changed during iteration')
+            for item in items[len(done):]:
+                if len(self) != n:
+                    raise RuntimeError('heapdict changed during iteration')
+                yield item
+            if len(items) < k:
+                return
+            done, k = items, 2 * k
+
+
+def _buckets_below(buckets, bound, start):
+    # Return the sorted (key, value) pairs below bound and not below start
+    # from dicts of keys to values covering increasing ranges of values,
+    # stopping at the first dict that reaches bound.
+    found = []
+    for bucket in buckets:
+        below = [item for item in bucket.items() if item[1] < bound]
+        found.extend(below)
+        if len(below) < len(bucket):
+            break
+    if start is not None:
+        found = [item for item in found if not item[1] < start]
+    found.sort(key=itemgetter(1))
+    return found
+
+
+# Marks a LazyHeapDict heap entry whose key was deleted or re-prioritised.
+_stale = object()
+
+
+class LazyHeapDict(_Engine):
+    """A heapdict that defers the heap work of changes and deletions.
+
+    Each heap entry is a [value, version, key] list, where the version is a
+    unique, increasing stamp that breaks ties without comparing keys.
+    Re-prioritising a key pushes a new entry and deleting one just marks its
+    entry stale; stale entries are skipped when they reach the top of the
+    heap. Once stale entries outnumber max_garbage times the live ones, the
+    heap is compacted, so max_garbage bounds the memory overhead. Use
+    heapdict(engine='lazy') to construct one."""
+
+    _options = ('max_garbage',)
+
+    def _check_invariants(self):
+        heap = self.heap
+        for i in range(1, len(heap)):
+            assert heap[(i - 1) >> 1] <= heap[i]
+        live = [e for e in heap if e[2] is not _stale]
+        assert len(live) == len(self.d)
+        assert len(heap) - len(live) == self.garbage
+        for e in live:
+            assert self.d[e[2]] is e
+
+    def __init__(self, *args, **kw):
+        _pop_implementation(self, kw)
+        _pop_binary(kw, 'lazy')
+        self.max_garbage = kw.pop('max_garbage', 1.0)
+        if not self.max_garbage >= 0:
+            raise ValueError('max_garbage must not be negative')
+        self.version = itertools.count()
+        self.garbage = 0
+        self.d = dict(*args, **kw)
+        self.heap = [[v, next(self.version), k] for (k, v) in self.d.items()]
+        self.d.update((e[2], e) for e in self.heap)
+        heapq.heapify(self.heap)
+
+    def __getstate__(self):
+        # The stale marker can't be pickled, so compact first and pickle the
+        # entries as flat lists in heap order.
+        if self.garbage:
+            self._compact()
+        state = self.__dict__.copy()
+        del state['heap'], state['d'], state['version']
+        state['values'] = [e[0] for e in self.heap]
+        state['versions'] = [e[1] for e in self.heap]
+        state['keys'] = [e[2] for e in self.heap]
+        return state
+
+    def __setstate__(self, state):
+        keys, versions = state.pop('keys'), state.pop('versions')
+        values = state.pop('values')
+        self.__dict__.update(state)
+        with _gc_paused():
+            self.heap = list(map(list, zip(values, versions, keys)))
+        self.d = dict(zip(keys, self.heap))
+        self.version = itertools.count(max(versions) + 1 if versions else 0)
+
+    def _compact(self):
+        self.heap[:] = [e for e in self.heap if e[2] is not _stale]
+        heapq.heapify(self.heap)
+        self.garbage = 0
+
+    def _discard(self, entry):
+        entry[2] = _stale
+        self.garbage += 1
+        if self.garbage > self.max_garbage * len(self.d):
+            self._compact()
+
+    def _pop_stale(self):
+        heap = self.heap
+        while heap[0][2] is _stale:  # raises IndexError if empty.
+            heapq.heappop(heap)
+            self.garbage -= 1
+
+    @doc(dict.clear)
+    def clear(self):
+        del self.heap[:]
+        self.d.clear()
+        self.garbage = 0
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        d = self.d
+        entry = [value, next(self.version), key]
+        old = d.get(key)
+        d[key] = entry
+        heapq.heappush(self.heap, entry)
+        if old is not None:
+            # Inlined _discard(), as this is the hot path.
+            old[2] = _stale
+            self.garbage += 1
+            if self.garbage > self.max_garbage * len(d):
+                self._compact()
+
+    @doc(heapdict.update)
+    def update(self, *args, **kw):
+        items = dict(*args, **kw)
+        d, heap, version = self.d, self.heap, self.version
+        if not _rebuild_is_cheaper(len(items), len(heap) + len(items), 2):
+            for key, value in items.items():
+                self[key] = value
+            return
+        for key, value in items.items():
+            entry = [value, next(version), key]
+            old = d.get(key)
+            if old is not None:
+                old[2] = _stale
+            d[key] = entry
+            heap.append(entry)
+        self._compact()
+
+    push_many = update
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        self._discard(self.d.pop(key))
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return self.d[key][0]
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        heap = self.heap
+        value, _, key = heapq.heappop(heap)  # raises IndexError if empty.
+        while key is _stale:
+            self.garbage -= 1
+            value, _, key = heapq.heappop(heap)
+        del self.d[key]
+        return (key, value)
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        self._pop_stale()
+        value, _, key = self.heap[0]
+        return (key, value)
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        heap = self.heap
+        items = []
+        # Stale entries are not returned but their children still are.
+        frontier = [(heap[0], 0)] if heap and n > 0 else []
+        while frontier:
+            entry, i = heapq.heappop(frontier)
+            if entry[2] is not _stale:
+                items.append((entry[2], entry[0]))
+                if len(items) == n:
+                    break
+            for c in xrange(2 * i + 1, min(2 * i + 3, len(heap))):
+                heapq.heappush(frontier, (heap[c], c))
+        return items
+
+    def _below(self, bound, start=None):
+        # As heapdict._below, passing through stale entries.
+        heap = self.heap
+        found = []
+        todo = [0] if heap and heap[0][0] < bound else []
+        while todo:
+            i = todo.pop()
+            value, _, key = heap[i]
+            if key is not _stale and (start is None or not value < start):
+                found.append((key, value))
+            for c in xrange(2 * i + 1, min(2 * i + 3, len(heap))):
+                if heap[c][0] < bound:
+                    todo.append(c)
+        found.sort(key=itemgetter(1))
+        return found
+
+
+def _meld(a, b):
+    # Meld two pairing heap roots and return the new root.
+    if b[0] < a[0]:
+        a, b = b, a
+    child = a[2]
+    if child is not None:
+        child[4] = b
+    b[3], b[4], a[2] = child, a, b
+    return a
+
+
+class PairingHeapDict(_Engine):
+    """A heapdict backed by a pairing heap.
+
+    Each item is a [value, key, child, next, prev] node, where child is the
+    leftmost child, next the right sibling and prev the left sibling, or the
+    parent for a leftmost child. Decreasing a value cuts the node's subtree
+    off and melds it with the root in O(1); restructuring is deferred to
+    popitem, which pairs up the root's children in O(log n) amortized time.
+    Use heapdict(engine='pairing') to construct one."""
+
+    def _check_invariants(self):
+        count = 0
+        todo = [] if self.root is None else [self.root]
+        if todo:
+            assert self.root[3] is None and self.root[4] is None
+        while todo:
+            node = todo.pop()
+            count += 1
+            assert self.d[node[1]] is node
+            prev, child = node, node[2]
+            while child is not None:
+                assert child[4] is prev
+                assert node[0] <= child[0]
+                todo.append(child)
+                prev, child = child, child[3]
+        assert count == len(self.d)
+
+    def __init__(self, *args, **kw):
+        _pop_implementation(self, kw)
+        _pop_binary(kw, 'pairing')
+        self.root = None
+        self.d = dict(*args, **kw)
+        for key, value in self.d.items():
+            node = self.d[key] = [value, key, None, None, None]
+            self.root = node if self.root is None else _meld(self.root, node)
+
+    def __getstate__(self):
+        # The nodes nest too deeply for pickle's recursion, so pickle the
+        # items and meld them back together when unpickling.
+        state = self.__dict__.copy()
+        del state['root'], state['d']
+        state['keys'] = list(self.d)
+        state['values'] = [node[0] for node in self.d.values()]
+        return state
+
+    def __setstate__(self, state):
+        keys, values = state.pop('keys'), state.pop('values')
+        self.__dict__.update(state)
+        self.root = None
+        self.d = {}
+        with _gc_paused():
+            for key, value in zip(keys, values):
+                node = self.d[key] = [value, key, None, None, None]
+                self.root = node if self.root is None else _meld(self.root, node)
+
+    def _cut(self, node):
+        # Detach the subtree rooted at node, which is not the root.
+        prev, next = node[4], node[3]
+        if prev[2] is node:
+            prev[2] = next
+        else:
+            prev[3] = next
+        if next is not None:
+            next[4] = prev
+        node[3] = node[4] = None
+
+    def _pair_children(self, node):
+        # Remove node's children, pair them up and return the merged subtree.
+        child = node[2]
+        if child is None:
+            return None
+        node[2] = None
+        # Meld adjacent pairs left to right, then the results right to left.
+        pairs = []
+        while child is not None:
+            other = child[3]
+            child[3] = child[4] = None
+            if other is None:
+                pairs.append(child)
+                break
+            next = other[3]
+            other[3] = other[4] = None
+            pairs.append(_meld(child, other))
+            child = next
+        root = pairs.pop()
+        while pairs:
+            root = _meld(pairs.pop(), root)
+        return root
+
+    def _remove(self, node):
+        rest = self._pair_children(node)
+        if node is self.root:
+            self.root = rest
+        else:
+            self._cut(node)
+            if rest is not None:
+                self.root = _meld(self.root, rest)
+
+    @doc(dict.clear)
+    def clear(self):
+        self.root = None
+        self.d.clear()
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        node = self.d.get(key)
+        if node is None:
+            node = self.d[key] = [value, key, None, None, None]
+            self.root = node if self.root is None else _meld(self.root, node)
+            return
+        oldvalue = node[0]
+        node[0] = value
+        if value < oldvalue:
+            if node is not self.root:
+                self._cut(node)
+                self.root = _meld(self.root, node)
+        elif oldvalue < value:
+            self._remove(node)
+            self.root = node if self.root is None else _meld(self.root, node)
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        self._remove(self.d.pop(key))
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return self.d[key][0]
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        root = self.root
+        if root is None:
+            raise IndexError('popitem(): heapdict is empty')
+        del self.d[root[1]]
+        self.root = self._pair_children(root)
+        return (root[1], root[0])
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        if self.root is None:
+            raise IndexError('peekitem(): heapdict is empty')
+        return (self.root[1], self.root[0])
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        items = []
+        # The counter breaks ties so nodes are never compared.
+        count = itertools.count()
+        root = self.root
+        frontier = [(root[0], 0, root)] if root is not None and n > 0 else []
+        while frontier:
+            value, _, node = heapq.heappop(frontier)
+            items.append((node[1], value))
+            if len(items) == n:
+                break
+            child = node[2]
+            while child is not None:
+                heapq.heappush(frontier, (child[0], next(count), child))
+                child = child[3]
+        return items
+
+    def _below(self, bound, start=None):
+        # Children are never below their parent, so the subtrees of nodes
+        # not below bound are skipped, though each found node's children
+        # are all looked at.
+        found = []
+        root = self.root
+        todo = [root] if root is not None and root[0] < bound else []
+        while todo:
+            node = todo.pop()
+            if start is None or not node[0] < start:
+                found.append((node[1], node[0]))
+            child = node[2]
+            while child is not None:
+                if child[0] < bound:
+                    todo.append(child)
+                child = child[3]
+        found.sort(key=itemgetter(1))
+        return found
+
+
+class RadixHeapDict(_Engine):
+    """A heapdict for non-negative integer priorities that are popped in
+    non-decreasing order, backed by a radix heap.
+
+    self.last is the last popped priority, and bucket i holds the items
+    whose priority first differs from it in bit i - 1, as a dict of keys to
+    values. Popping an item only ever moves items to lower buckets, so each
+    item is moved at most once per bit without ever comparing priorities.
+    Setting a priority below self.last raises ValueError, and setting one
+    that is not an integer raises TypeError, leaving the heapdict as it was.
+    Use heapdict(engine='radix') to construct one."""
+
+    def _check_invariants(self):
+        count = 0
+        for i, bucket in enumerate(self.buckets):
+            for key, value in bucket.items():
+                assert value >= self.last
+                assert (value ^ self.last).bit_length() == i
+                assert self.d[key] == value
+            count += len(bucket)
+        assert count == len(self.d)
+
+    def __init__(self, *args, **kw):
+        _pop_implementation(self, kw)
+        _pop_binary(kw, 'radix')
+        self.last = 0
+        self.buckets = [{}]
+        self.d = dict(*args, **kw)
+        buckets = self.buckets
+        for key, value in self.d.items():
+            i = self._bucket(value)
+            while len(buckets) <= i:
+                buckets.append({})
+            buckets[i][key] = value
+
+    def _bucket(self, value):
+        # Return the index of the bucket for value, raising TypeError or
+        # ValueError if it can't go in any.
+        if not isinstance(value, _integers):
+            raise TypeError('radix heapdict priorities must be integers, '
+                            'not %r' % (value,))
+        if value < self.last:
+            raise ValueError('radix heapdict priority %r is below the last '
+                             'popped priority %r' % (value, self.last))
+        return (value ^ self.last).bit_length()
+
+    def _first(self):
+        # Return the index of the first non-empty bucket.
+        for i, bucket in enumerate(self.buckets):
+            if bucket:
+                return i
+        raise IndexError('heapdict is empty')
+
+    def _advance(self, i, last):
+        # Raise self.last to last, the minimum of bucket i, and redistribute
+        # bucket i into the lower buckets.
+        buckets = self.buckets
+        bucket = buckets[i]
+        buckets[i] = {}
+        self.last = last
+        for key, value in bucket.items():
+            buckets[(value ^ last).bit_length()][key] = value
+
+    def _unshare(self):
+        self.buckets = [dict(b) for b in self.buckets]
+        self.d = dict(self.d)
+
+    @doc(dict.clear)
+    def clear(self):
+        self.last = 0
+        self.buckets = [{}]
+        self.d.clear()
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        i = self._bucket(value)
+        d, buckets = self.d, self.buckets
+        if key in d:
+            del buckets[(d[key] ^ self.last).bit_length()][key]
+        while len(buckets) <= i:
+            buckets.append({})
+        d[key] = buckets[i][key] = value
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        value = self.d.pop(key)
+        del self.buckets[(value ^ self.last).bit_length()][key]
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return self.d[key]
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        if not self.buckets[0]:
+            i = self._first()
+            self._advance(i, min(self.buckets[i].values()))
+        key, value = self.buckets[0].popitem()
+        del self.d[key]
+        return (key, value)
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        bucket = self.buckets[self._first()]
+        key = min(bucket, key=bucket.__getitem__)
+        return (key, bucket[key])
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        items = []
+        # Every priority in a bucket is below those in later buckets.
+        for bucket in self.buckets:
+            if len(items) >= n:
+                break
+            items.extend(sorted(bucket.items(), key=itemgetter(1)))
+        return items[:max(n, 0)]
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        items = []
+        buckets, d = self.buckets, self.d
+        while d:
+            if not buckets[0]:
+                i = self._first()
+                last = min(buckets[i].values())
+                if last > threshold:
+                    break
+                self._advance(i, last)
+            elif self.last > threshold:
+                break
+            items.extend(buckets[0].items())
+            for key in buckets[0]:
+                del d[key]
+            buckets[0].clear()
+        return items
+
+    def _below(self, bound, start=None):
+        return _buckets_below(self.buckets, bound, start)
+
+
+class CalendarHeapDict(_Engine):
+    """A heapdict backed by a calendar queue, for priorities such as
+    timestamps that are rescheduled often within a bounded horizon.
+
+    Each priority is put in the bucket numbered priority // width, a dict of
+    keys to priorities, and self.order is a heap of the bucket numbers in
+    self.buckets. Rescheduling a key to an existing bucket is O(1); popitem
+    scans the first non-empty bucket, so width should be chosen so buckets
+    hold only a few items. Emptied buckets are kept until they reach the
+    front of self.order. Use heapdict(engine='calendar', width=w) to
+    construct one."""
+
+    _options = ('width',)
+
+    def _check_invariants(self):
+        assert sorted(self.order) == sorted(self.buckets)
+        count = 0
+        for n, bucket in self.buckets.items():
+            for key, value in bucket.items():
+                assert value // self.width == n
+                assert self.d[key] == value
+            count += len(bucket)
+        assert count == len(self.d)
+
+    def __init__(self, *args, **kw):
+        _pop_implementation(self, kw)
+        _pop_binary(kw, 'calendar')
+        self.width = kw.pop('width', 1.0)
+        if not self.width > 0:
+            raise ValueError('calendar bucket width must be positive')
+        self.buckets = {}
+        self.order = []
+        self.d = dict(*args, **kw)
+        for key, value in self.d.items():
+            self._bucket(value)[key] = value
+
+    def _bucket(self, value):
+        # Return the bucket for value, creating it if needed.
+        n = value // self.width
+        bucket = self.buckets.get(n)
+        if bucket is None:
+            bucket = self.buckets[n] = {}
+            heapq.heappush(self.order, n)
+        return bucket
+
+    def _first(self):
+        # Return the first non-empty bucket, dropping empty ones before it.
+        order, buckets = self.order, self.buckets
+        while order:
+            bucket = buckets[order[0]]
+            if bucket:
+                return bucket
+            del buckets[heapq.heappop(order)]
+        raise IndexError('heapdict is empty')
+
+    def _unshare(self):
+        self.buckets = dict((n, dict(b)) for (n, b) in self.buckets.items())
+        self.order = list(self.order)
+        self.d = dict(self.d)
+
+    @doc(dict.clear)
+    def clear(self):
+        self.buckets.clear()
+        del self.order[:]
+        self.d.clear()
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        d = self.d
+        if key in d:
+            del self.buckets[d[key] // self.width][key]
+        self._bucket(value)[key] = d[key] = value
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        del self.buckets[self.d.pop(key) // self.width][key]
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return self.d[key]
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        bucket = self._first()
+        key = min(bucket, key=bucket.__getitem__)
+        del self.d[key]
+        return (key, bucket.pop(key))
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        bucket = self._first()
+        key = min(bucket, key=bucket.__getitem__)
+        return (key, bucket[key])
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        items = []
+        for i in sorted(self.order):
+            if len(items) >= n:
+                break
+            items.extend(sorted(self.buckets[i].items(), key=itemgetter(1)))
+        return items[:max(n, 0)]
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        items = []
+        d = self.d
+        while d:
+            bucket = self._first()
+            due = [(k, v) for (k, v) in bucket.items() if v <= threshold]
+            due.sort(key=itemgetter(1))
+            items.extend(due)
+            for key, _ in due:
+                del bucket[key]
+                del d[key]
+            # Anything left in this bucket, and every later bucket, is due
+            # after threshold.
+            if bucket:
+                break
+        return items
+
+    def _below(self, bound, start=None):
+        buckets = self.buckets
+        return _buckets_below((buckets[i] for i in sorted(self.order)),
+                              bound, start)
+
+
+def _levels_heapify(values, heap, n):
+    # Heapify values[:n], moving heap[:n] along with it. The nodes on one
+    # level have disjoint subtrees, so a whole level is sifted down at once,
+    # one step per array operation, working up from the lowest parents.
+    last = (n - 2) // 2
+    if last < 0:
+        return
+    level = int(last + 1).bit_length() - 1
+    while level >= 0:
+        start = (1 << level) - 1
+        nodes = numpy.arange(start, min(2 * start + 1, last + 1))
+        while nodes.size:
+            child = 2 * nodes + 1
+            inside = child < n
+            nodes, child = nodes[inside], child[inside]
+            right = child + 1
+            has_right = right < n
+            both = numpy.flatnonzero(has_right)
+            better = values[right[both]] < values[child[both]]
+            child[both[better]] += 1
+            swap = values[child] < values[nodes]
+            nodes, child = nodes[swap], child[swap]
+            values[nodes], values[child] = values[child], values[nodes]
+            heap[nodes], heap[child] = heap[child], heap[nodes]
+            nodes = child
+        level -= 1
+
+
+def _numpy_rebuild_is_cheaper(k, n):
+    # Each sift is a Python loop over array elements, while a vectorised
+    # rebuild costs a few microseconds per level plus a pass over the items.
+    return k * math.log(n + 1, 2) > n / 8.0
+
+
+class NumpyHeapDict(_Engine):
+    """A binary heapdict that keeps float64 priorities in NumPy arrays.
+
+    Each key is given an integer slot: self.heap holds the slots and
+    self.priorities their priorities in heap order, self.positions maps each slot
+    to its heap position, and self.slotkeys maps it back to its key. Single
+    changes sift through the arrays from Python and are slower than a list
+    heap, but update_many(), heapify() and the batch pops work a whole heap
+    level at a time. Priorities are stored and returned as floats. Use
+    heapdict(engine='numpy') to construct one; it needs NumPy."""
+
+    def _check_invariants(self):
+        n = self.n
+        values, heap = self.priorities[:n], self.heap[:n]
+        assert len(self.slots) == n
+        for key, slot in self.slots.items():
+            assert self.slotkeys[slot] == key
+            assert heap[self.positions[slot]] == slot
+        assert (values[(numpy.arange(1, n) - 1) // 2] <= values[1:]).all()
+
+    def __init__(self, *args, **kw):
+        if numpy is None:
+            raise ImportError('the numpy heapdict engine needs numpy')
+        _pop_implementation(self, kw)
+        _pop_binary(kw, 'numpy')
+        self.clear()
+        items = dict(*args, **kw)
+        self.update_many(list(items), list(items.values()))
+
+    def _unshare(self):
+        self.slots, self.slotkeys = dict(self.slots), list(self.slotkeys)
+        self.free = list(self.free)
+        self.priorities = self.priorities.copy()
+        self.heap, self.positions = self.heap.copy(), self.positions.copy()
+
+    def _reserve(self, m):
+        # Make room for m more items. There are never more slots than the
+        # largest number of items held, so all the arrays share a capacity.
+        size = len(self.priorities)
+        if self.n + m <= size:
+            return
+        size = max(self.n + m, 2 * size)
+        for name, dtype in (('priorities', numpy.float64), ('heap', numpy.intp),
+                            ('positions', numpy.intp)):
+            old = getattr(self, name)
+            new = numpy.empty(size, dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _new_slot(self, key):
+        if self.free:
+            slot = self.free.pop()
+            self.slotkeys[slot] = key
+        else:
+            slot = len(self.slotkeys)
+            self.slotkeys.append(key)
+        self.slots[key] = slot
+        return slot
+
+    def _free_slot(self, slot):
+        del self.slots[self.slotkeys[slot]]
+        self.slotkeys[slot] = None
+        self.free.append(slot)
+
+    def _siftdown(self, pos):
+        # Move the item at pos towards the root.
+        values, heap, positions = self.priorities, self.heap, self.positions
+        value, slot = values[pos], heap[pos]
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if value >= values[parent]:
+                break
+            values[pos] = values[parent]
+            heap[pos] = heap[parent]
+            positions[heap[pos]] = pos
+            pos = parent
+        values[pos], heap[pos], positions[slot] = value, slot, pos
+
+    def _siftup(self, pos):
+        # Move the item at pos towards the leaves.
+        values, heap, positions, n = self.priorities, self.heap, self.positions, self.n
+        value, slot = values[pos], heap[pos]
+        child = 2 * pos + 1
+        while child < n:
+            if child + 1 < n and values[child + 1] < values[child]:
+                child += 1
+            if value <= values[child]:
+                break
+            values[pos] = values[child]
+            heap[pos] = heap[child]
+            positions[heap[pos]] = pos
+            pos, child = child, 2 * child + 1
+        values[pos], heap[pos], positions[slot] = value, slot, pos
+
+    def heapify(self):
+        """D.heapify() -> None.  Rebuild the heap with vectorised passes over whole levels."""
+        n = self.n
+        _levels_heapify(self.priorities[:n], self.heap[:n], n)
+        self.positions[self.heap[:n]] = numpy.arange(n)
+
+    def _remove(self, pos):
+        # Remove the item at pos and return its (key, value) pair.
+        values, heap = self.priorities, self.heap
+        slot, value = heap[pos], values[pos]
+        self.n = last = self.n - 1
+        if pos != last:
+            values[pos], heap[pos] = values[last], heap[last]
+            self.positions[heap[pos]] = pos
+            if pos > 0 and values[pos] < values[(pos - 1) >> 1]:
+                self._siftdown(pos)
+            else:
+                self._siftup(pos)
+        key = self.slotkeys[slot]
+        self._free_slot(slot)
+        return (key, float(value))
+
+    def _take(self, chosen):
+        # Remove the items at the positions in the array chosen and return
+        # their (key, value) pairs in increasing value order, then heapify
+        # the rest.
+        n = self.n
+        values, heap = self.priorities, self.heap
+        chosen = chosen[numpy.argsort(values[chosen], kind='stable')]
+        slots, taken = heap[chosen].tolist(), values[chosen].tolist()
+        keep = numpy.ones(n, bool)
+        keep[chosen] = False
+        rest = numpy.flatnonzero(keep)
+        self.n = m = len(rest)
+        values[:m], heap[:m] = values[rest], heap[rest]
+        self.heapify()
+        keys = [self.slotkeys[s] for s in slots]
+        for slot in slots:
+            self._free_slot(slot)
+        return list(zip(keys, taken))
+
+    @doc(dict.clear)
+    def clear(self):
+        self.slots = {}
+        self.slotkeys = []
+        self.free = []
+        self.n = 0
+        self.priorities = numpy.empty(8, numpy.float64)
+        self.heap = numpy.empty(8, numpy.intp)
+        self.positions = numpy.empty(8, numpy.intp)
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        value = float(value)
+        slot = self.slots.get(key)
+        if slot is None:
+            self._reserve(1)
+            slot = self._new_slot(key)
+            pos = self.n
+            self.n += 1
+            self.priorities[pos], self.heap[pos], self.positions[slot] = value, slot, pos
+            self._siftdown(pos)
+        else:
+            pos = self.positions[slot]
+            old = self.priorities[pos]
+            self.priorities[pos] = value
+            if old < value:
+                self._siftup(pos)
+            else:
+                self._siftdown(pos)
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        self._remove(self.positions[self.slots[key]])
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return float(self.priorities[self.positions[self.slots[key]]])
+
+    @doc(dict.__contains__)
+    def __contains__(self, key):
+        return key in self.slots
+
+    @doc(dict.__iter__)
+    def __iter__(self):
+        return iter(self.slots)
+
+    @doc(dict.__len__)
+    def __len__(self):
+        return self.n
+
+    def update_many(self, keys, priorities):
+        """D.update_many(keys, priorities) -> None.  Set D[k] = p for each key k and the
+priority p at the same index of the sequence or array priorities. Large
+batches are written into the arrays and the heap rebuilt by heapify()."""
+        keys = list(keys)
+        priorities = numpy.asarray(priorities, dtype=numpy.float64)
+        if priorities.shape != (len(keys),):
+            raise ValueError('update_many needs one priority per key')
+        # The last priority given for a key wins.
+        last = dict(zip(keys, xrange(len(keys))))
+        if len(last) < len(keys):
+            keys = list(last)
+            priorities = priorities[list(last.values())]
+        if not _numpy_rebuild_is_cheaper(len(keys), self.n + len(keys)):
+            for key, value in zip(keys, priorities.tolist()):
+                self[key] = value
+            return
+        slots = numpy.array([self.slots.get(k, -1) for k in keys], numpy.intp)
+        new = slots < 0
+        old = ~new
+        self.priorities[self.positions[slots[old]]] = priorities[old]
+        added = [k for (k, s) in zip(keys, slots.tolist()) if s < 0]
+        self._reserve(len(added))
+        start, self.n = self.n, self.n + len(added)
+        added = numpy.array([self._new_slot(k) for k in added], numpy.intp)
+        self.heap[start:self.n] = added
+        self.priorities[start:self.n] = priorities[new]
+        self.heapify()
+
+    @doc(heapdict.update)
+    def update(self, *args, **kw):
+        items = dict(*args, **kw)
+        self.update_many(list(items), list(items.values()))
+
+    push_many = update
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        if not self.n:
+            raise IndexError('heapdict is empty')
+        return self._remove(0)
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        if not self.n:
+            raise IndexError('heapdict is empty')
+        return (self.slotkeys[self.heap[0]], float(self.priorities[0]))
+
+    @doc(heapdict.popmany)
+    def popmany(self, n):
+        n = min(n, self.n)
+        if n <= 0:
+            return []
+        if not _numpy_rebuild_is_cheaper(n, self.n):
+            return [self._remove(0) for _ in xrange(n)]
+        return self._take(numpy.argpartition(self.priorities[:self.n], n - 1)[:n])
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        chosen = numpy.flatnonzero(self.priorities[:self.n] <= threshold)
+        if not _numpy_rebuild_is_cheaper(len(chosen), self.n):
+            return [self._remove(0) for _ in xrange(len(chosen))]
+        return self._take(chosen)
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        values, heap, keys = self.priorities, self.heap, self.slotkeys
+        items = []
+        frontier = [(float(values[0]), 0)] if self.n and n > 0 else []
+        while frontier:
+            value, i = heapq.heappop(frontier)
+            items.append((keys[heap[i]], value))
+            if len(items) == n:
+                break
+            for c in xrange(2 * i + 1, min(2 * i + 3, self.n)):
+                heapq.heappush(frontier, (float(values[c]), c))
+        return items
+
+    def _below(self, bound, start=None):
+        # One comparison over the array beats walking the heap from Python.
+        values = self.priorities[:self.n]
+        mask = values < bound
+        if start is not None:
+            mask &= values >= start
+        chosen = numpy.flatnonzero(mask)
+        chosen = chosen[numpy.argsort(values[chosen], kind='stable')]
+        keys = self.slotkeys
+        return [(keys[s], v) for s, v in zip(self.heap[chosen].tolist(),
+                                             values[chosen].tolist())]
+
+    @doc(heapdict.count_below)
+    def count_below(self, x):
+        return int(numpy.count_nonzero(self.priorities[:self.n] < x))
+
+
+class SortedHeapDict(_Engine):
+    """A heapdict kept as a sorted list, for heaps of up to a few hundred items.
+
+    Each item is a [value, seq, key] entry, where seq is a unique stamp that
+    breaks ties without comparing keys, and self.entries holds them in
+    increasing order. Setting a priority moves its entry with bisect, which
+    is O(n) but only a memmove, and for small heaps that beats the Python
+    loop of a sift. Use heapdict(engine='sorted') to construct one."""
+
+    def _check_invariants(self):
+        entries = self.entries
+        for i in range(1, len(entries)):
+            assert entries[i - 1] < entries[i]
+        assert len(entries) == len(self.d)
+        for e in entries:
+            assert self.d[e[2]] is e
+
+    def __init__(self, *args, **kw):
+        _pop_implementation(self, kw)
+        _pop_binary(kw, 'sorted')
+        self.d = dict(*args, **kw)
+        self.entries = [[v, i, k] for (i, (k, v)) in enumerate(self.d.items())]
+        self.seq = len(self.entries)
+        self.d.update((e[2], e) for e in self.entries)
+        self.entries.sort()
+
+    def _unshare(self):
+        self.entries = [list(e) for e in self.entries]
+        self.d = dict((e[2], e) for e in self.entries)
+
+    @doc(dict.clear)
+    def clear(self):
+        del self.entries[:]
+        self.d.clear()
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        entries = self.entries
+        entry = self.d.get(key)
+        if entry is None:
+            entry = self.d[key] = [value, self.seq, key]
+            self.seq += 1
+        else:
+            del entries[bisect.bisect_left(entries, entry)]
+            entry[0] = value
+        bisect.insort(entries, entry)
+
+    @doc(heapdict.update)
+    def update(self, *args, **kw):
+        items = dict(*args, **kw)
+        d, entries = self.d, self.entries
+        if not _rebuild_is_cheaper(len(items), len(entries) + len(items), 2):
+            for key, value in items.items():
+                self[key] = value
+            return
+        for key, value in items.items():
+            entry = d.get(key)
+            if entry is None:
+                entry = d[key] = [value, self.seq, key]
+                self.seq += 1
+                entries.append(entry)
+            else:
+                entry[0] = value
+        entries.sort()
+
+    push_many = update
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        entry = self.d.pop(key)
+        del self.entries[bisect.bisect_left(self.entries, entry)]
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return self.d[key][0]
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        if not self.entries:
+            raise IndexError('popitem(): heapdict is empty')
+        value, _, key = self.entries.pop(0)
+        del self.d[key]
+        return (key, value)
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        if not self.entries:
+            raise IndexError('peekitem(): heapdict is empty')
+        value, _, key = self.entries[0]
+        return (key, value)
+
+    @doc(heapdict.popmany)
+    def popmany(self, n):
+        items = self.nsmallest(n)
+        del self.entries[:len(items)]
+        for key, _ in items:
+            del self.d[key]
+        return items
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        return [(e[2], e[0]) for e in self.entries[:max(n, 0)]]
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        # A seq never exceeds infinity, so this bisects past every entry
+        # with a value of threshold.
+        return self.popmany(bisect.bisect_right(self.entries,
+                                                [threshold, float('inf')]))
+
+    def _below(self, bound, start=None):
+        # [x] sorts before every entry with value x.
+        entries = self.entries
+        i = 0 if start is None else bisect.bisect_left(entries, [start])
+        return [(e[2], e[0])
+                for e in entries[i:bisect.bisect_left(entries, [bound])]]
+
+    @doc(heapdict.count_below)
+    def count_below(self, x):
+        return bisect.bisect_left(self.entries, [x])
+
+
+# AutoHeapDict watches windows of this many operations, and for heaps of at
+# most _AUTO_SMALL items in a whole window picks the sorted engine, which it
+# leaves as soon as it grows past _AUTO_LARGE.
+_AUTO_WINDOW = 512
+_AUTO_SMALL = 64
+_AUTO_LARGE = 512
+
+
+class AutoHeapDict(_Engine):
+    """A heapdict that picks its engine from the operations it is given.
+
+    It keeps its items in another engine, self.h, named by self.engine, and
+    now and then watches a window of operations: the share of new keys,
+    decreases, increases, deletes and pops, the largest size, and whether
+    every priority is a non-negative int at or above the last one popped. A
+    heap that stays small is kept sorted, monotone int priorities go to the
+    radix engine, a mix dominated by changes to existing priorities to the
+    pairing heap, and the rest to the lazy heap, whose pushes and pops run
+    in C. It migrates only when two windows in a row agree, and then leaves
+    at least len(D) operations unwatched, so rebuilding the items in the new
+    engine costs O(1) amortized per operation. A priority the radix engine
+    rejects moves the items back to the default heap on the spot.
+    self.history lists the engines used, oldest first. Use
+    heapdict(engine='auto') to construct one."""
+
+    def _check_invariants(self):
+        assert isinstance(self.h, _engines[self.engine]['list'])
+        assert self.history[-1] == self.engine
+        self.h._check_invariants()
+
+    def __init__(self, *args, **kw):
+        _pop_implementation(self, kw)
+        _pop_binary(kw, 'auto')
+        h = heapdict(*args, **kw)
+        self.engine = 'heap' if len(h) > _AUTO_SMALL else 'sorted'
+        self.h = h if self.engine == 'heap' else SortedHeapDict(h.items())
+        self.history = [self.engine]
+        # The engine the last window chose, if it differs from self.engine.
+        self.candidate = None
+        self._start_window()
+
+    def _start_window(self):
+        # Watch the next operation onwards; it is watched once countdown
+        # goes negative, and the window ends at -_AUTO_WINDOW.
+        self.countdown = 0
+        self.counts = dict.fromkeys(
+            ('push', 'decrease', 'increase', 'delete', 'pop'), 0)
+        self.peak = len(self.h)
+        self.monotone = True
+        self.floor = 0
+
+    def _unshare(self):
+        self.h = self.h.copy()
+        self.counts = dict(self.counts)
+        self.history = list(self.history)
+
+    def _migrate(self, engine):
+        with _gc_paused():
+            self.h = heapdict(dict(self.h.items()), engine=engine)
+        self.engine = engine
+        self.history.append(engine)
+        self.candidate = None
+
+    def _leave_radix(self):
+        # The radix engine raised for a priority below the last one popped or
+        # not a non-negative int. Move to the default heap and watch a fresh
+        # window.
+        self._migrate('heap')
+        self._start_window()
+
+    def _choose(self):
+        counts = self.counts
+        if self.peak <= _AUTO_SMALL:
+            return 'sorted'
+        if self.monotone:
+            return 'radix'
+        if 2 * (counts['decrease'] + counts['increase']) > sum(counts.values()):
+            return 'pairing'
+        return 'lazy'
+
+    def _observe(self, op, n=1):
+        # Count n operations of kind op in the window, and when the window is
+        # over, migrate if it and the window before chose the same engine.
+        self.counts[op] += n
+        size = len(self.h)
+        if size > self.peak:
+            self.peak = size
+            if self.engine == 'sorted' and size > _AUTO_LARGE:
+                self._migrate('heap')
+                self._start_window()
+                return
+        if self.countdown > -_AUTO_WINDOW:
+            return
+        engine = self._choose()
+        if engine == self.engine:
+            self.candidate = None
+        elif engine == self.candidate:
+            try:
+                self._migrate(engine)
+            except (TypeError, ValueError):
+                # Items the window did not see don't suit the radix engine.
+                self.candidate = None
+        else:
+            self.candidate = engine
+        self._start_window()
+        # A candidate is confirmed by the very next window, but after that,
+        # or a migration, len(D) operations go unwatched.
+        if self.candidate is None:
+            self.countdown = max(_AUTO_WINDOW, len(self.h))
+
+    def _observe_set(self, key, value):
+        h = self.h
+        if key not in h:
+            op = 'push'
+        elif value < h[key]:
+            op = 'decrease'
+        else:
+            op = 'increase'
+        if self.monotone and not (type(value) in _integers
+                                  and value >= self.floor):
+            self.monotone = False
+        return op
+
+    def _observe_pops(self, items):
+        for _, value in items:
+            if value < self.floor:
+                self.monotone = False
+            self.floor = value
+        self._observe('pop', len(items))
+
+    @doc(dict.clear)
+    def clear(self):
+        self.h.clear()
+        self._start_window()
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        self.countdown -= 1
+        op = self._observe_set(key, value) if self.countdown < 0 else None
+        try:
+            self.h[key] = value
+        except (TypeError, ValueError):
+            if self.engine != 'radix':
+                raise
+            self._leave_radix()
+            self.h[key] = value
+        if op is not None:
+            self._observe(op)
+
+    @doc(heapdict.update)
+    def update(self, *args, **kw):
+        items = dict(*args, **kw)
+        try:
+            self.h.update(items)
+        except (TypeError, ValueError):
+            if self.engine != 'radix':
+                raise
+            self._leave_radix()
+            self.h.update(items)
+        self.countdown -= len(items)
+        if self.countdown < 0 and items:
+            self._observe('push', len(items))
+        elif self.engine == 'sorted' and len(self.h) > _AUTO_LARGE:
+            self._migrate('heap')
+            self._start_window()
+
+    push_many = update
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        del self.h[key]
+        self.countdown -= 1
+        if self.countdown < 0:
+            self._observe('delete')
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return self.h[key]
+
+    @doc(dict.__contains__)
+    def __contains__(self, key):
+        return key in self.h
+
+    @doc(dict.__iter__)
+    def __iter__(self):
+        return iter(self.h)
+
+    @doc(dict.__len__)
+    def __len__(self):
+        return len(self.h)
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        item = self.h.popitem()
+        self.countdown -= 1
+        if self.countdown < 0:
+            self._observe_pops([item])
+        return item
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        return self.h.peekitem()
+
+    @doc(heapdict.popmany)
+    def popmany(self, n):
+        items = self.h.popmany(n)
+        self.countdown -= len(items)
+        if self.countdown < 0 and items:
+            self._observe_pops(items)
+        return items
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        items = self.h.pop_until(threshold)
+        self.countdown -= len(items)
+        if self.countdown < 0 and items:
+            self._observe_pops(items)
+        return items
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        return self.h.nsmallest(n)
+
+    @doc(heapdict.iter_sorted)
+    def iter_sorted(self):
+        return self.h.iter_sorted()
+
+    @doc(heapdict.count_below)
+    def count_below(self, x):
+        return self.h.count_below(x)
+
+    @doc(heapdict.items_below)
+    def items_below(self, x):
+        return self.h.items_below(x)
+
+    @doc(heapdict.items_in_range)
+    def items_in_range(self, a, b):
+        return self.h.items_in_range(a, b)
+
+
+_engines = {
+    'heap': {'list': heapdict, 'compact': CompactHeapDict},
+    'lazy': {'list': LazyHeapDict},
+    'pairing': {'list': PairingHeapDict},
+    'radix': {'list': RadixHeapDict},
+    'calendar': {'list': CalendarHeapDict},
+    'numpy': {'list': NumpyHeapDict},
+    'sorted': {'list': SortedHeapDict},
+    'auto': {'list': AutoHeapDict},
+}
+
+
+def _implementation(engine, storage, instrument=False, keyed=False):
+    try:
+        storages = _engines[engine or 'heap']
+    except KeyError:
+        raise ValueError('unknown heapdict engine %r' % (engine,))
+    try:
+        cls = storages[storage or 'list']
+    except KeyError:
+        raise ValueError('heapdict engine %r does not support storage %r'
+                         % (engine or 'heap', storage))
+    if instrument and keyed:
+        raise ValueError('a keyed heapdict cannot be instrumented')
+    if instrument or keyed:
+        if cls is not heapdict:
+            raise ValueError('only the default heapdict supports %s'
+                             % ('instrument' if instrument else 'key and reverse'))
+        cls = InstrumentedHeapDict if instrument else KeyedHeapDict
+    return cls
+
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class BlockingHeapDict(MutableMapping):
+    """A thread-safe heapdict whose pops can wait for items to arrive.
+
+    Arguments other than clock are passed to heapdict() to make the heap, so
+    any engine can be used. Every method holds the lock only for the heap
+    operation itself. pop() and pop_due() wait on condition variables rather
+    than polling, and pop_due() without a now argument treats priorities as
+    times on clock, which defaults to time.time."""
+
+    def _check_invariants(self):
+        with self.lock:
+            self.h._check_invariants()
+
+    def __init__(self, *args, **kw):
+        self.clock = kw.pop('clock', time.time)
+        self.h = heapdict(*args, **kw)
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.earlier = threading.Condition(self.lock)
+        # How many threads are in pop() and pop_due() waits, to skip
+        # notifying nobody.
+        self.waiting = self.waiting_due = 0
+
+    def __getstate__(self):
+        with self.lock:
+            return {'h': self.h, 'clock': self.clock}
+
+    def __setstate__(self, state):
+        self.__init__(clock=state['clock'])
+        self.h = state['h']
+
+    @doc(heapdict.copy)
+    def copy(self):
+        with self.lock:
+            h = self.h.copy()
+        other = self.__class__.__new__(self.__class__)
+        other.__setstate__({'h': h, 'clock': self.clock})
+        return other
+
+    __copy__ = copy
+
+    def _set(self, key, value):
+        # Set D[key] and wake the waiters it concerns; the lock must be held.
+        h = self.h
+        n = len(h)
+        h[key] = value
+        if self.waiting and len(h) > n:
+            self.not_empty.notify()
+        if self.waiting_due and h.peekitem()[0] == key:
+            self.earlier.notify_all()
+
+    @doc(dict.clear)
+    def clear(self):
+        with self.lock:
+            self.h.clear()
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        with self.lock:
+            self._set(key, value)
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        with self.lock:
+            del self.h[key]
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        with self.lock:
+            return self.h[key]
+
+    @doc(dict.__contains__)
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.h
+
+    @doc(dict.__iter__)
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.h))
+
+    @doc(dict.__len__)
+    def __len__(self):
+        return len(self.h)
+
+    @doc(heapdict.update)
+    def update(self, *args, **kw):
+        with self.lock:
+            self.h.update(*args, **kw)
+            if self.h:
+                self.not_empty.notify_all()
+                self.earlier.notify_all()
+
+    push_many = update
+
+    @doc(heapdict.merge)
+    def merge(self, other, conflict=min):
+        with self.lock:
+            self.h.merge(other, conflict)
+            if self.h:
+                self.not_empty.notify_all()
+                self.earlier.notify_all()
+
+    @doc(heapdict.transaction)
+    def transaction(self):
+        # Reads go through the lock one call at a time, while a commit holds
+        # it throughout.
+        return _Transaction(self, getattr(self.h, '_sortkey', None))
+
+    def _commit(self, values, deleted):
+        with self.lock:
+            self.h._commit(values, deleted)
+            if values:
+                self.not_empty.notify_all()
+                self.earlier.notify_all()
+
+    def reprioritize(self, key, func):
+        """D.reprioritize(k, f) -> v, atomically set D[k] to v = f(D[k]) and return v."""
+        with self.lock:
+            value = func(self.h[key])
+            self._set(key, value)
+            return value
+
+    @doc(heapdict.bump)
+    def bump(self, key, amount=1, default=None):
+        with self.lock:
+            if key not in self.h:
+                return default
+            value = self.h[key] + amount
+            self._set(key, value)
+            return value
+
+    def pop(self, *args, **kw):
+        """D.pop([k,[,d]], timeout=0) -> v, as heapdict.pop(), except that with no key
+it waits up to timeout seconds, or forever if timeout is None, for an item to
+arrive before raising IndexError."""
+        timeout = kw.pop('timeout', 0)
+        if kw:
+            raise TypeError('unexpected keyword arguments %r' % list(kw))
+        with self.lock:
+            if args:
+                return self.h.pop(*args)
+            end = None if timeout is None else _monotonic() + timeout
+            while not self.h:
+                remaining = None if end is None else end - _monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise IndexError('pop(): no item arrived in time')
+                self.waiting += 1
+                try:
+                    self.not_empty.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            return self.h.popitem()[0]
+
+    def pop_due(self, now=None, timeout=None):
+        """D.pop_due([now], timeout=None) -> (k, v), wait until the lowest value is at or
+below now, or if now is None, until clock() reaches it, then remove and return
+that (key, value) pair. An earlier item arriving is picked up straight away.
+Waits up to timeout seconds, or forever if timeout is None, and raises
+IndexError if nothing is due by then."""
+        with self.lock:
+            end = None if timeout is None else _monotonic() + timeout
+            while True:
+                current = self.clock() if now is None else now
+                wait = None
+                if self.h:
+                    value = self.h.peekitem()[1]
+                    if value <= current:
+                        return self.h.popitem()
+                    if now is None:
+                        wait = value - current
+                if end is not None:
+                    remaining = end - _monotonic()
+                    if remaining <= 0:
+                        raise IndexError('pop_due(): no item was due in time')
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.waiting_due += 1
+                try:
+                    self.earlier.wait(wait)
+                finally:
+                    self.waiting_due -= 1
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        with self.lock:
+            return self.h.popitem()
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        with self.lock:
+            return self.h.peekitem()
+
+    @doc(heapdict.popmany)
+    def popmany(self, n):
+        with self.lock:
+            return self.h.popmany(n)
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        with self.lock:
+            return self.h.nsmallest(n)
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        with self.lock:
+            return self.h.pop_until(threshold)
+
+    @doc(heapdict.iter_sorted)
+    def iter_sorted(self):
+        # The lock is held for each step rather than the whole iteration.
+        items = self.h.iter_sorted()
+        while True:
+            with self.lock:
+                item = next(items, None)
+            if item is None:
+                return
+            yield item
+
+    @doc(heapdict.count_below)
+    def count_below(self, x):
+        with self.lock:
+            return self.h.count_below(x)
+
+    @doc(heapdict.items_below)
+    def items_below(self, x):
+        with self.lock:
+            return self.h.items_below(x)
+
+    @doc(heapdict.items_in_range)
+    def items_in_range(self, a, b):
+        with self.lock:
+            return self.h.items_in_range(a, b)
+
+
+class ExpiringDict(MutableMapping):
+    """A dict whose keys expire ttl seconds after they are set.
+
+    A heapdict maps each key to its expiry time on clock, so the next key to
+    expire is always at its top. Expired keys are removed when looked up,
+    and every write also removes up to batch of them, spreading a mass
+    expiry over later writes instead of stalling one. set() takes a per-key
+    ttl, and with refresh=True reading a key restarts its ttl. len() counts
+    expired keys that have not been removed yet; expire() removes them all.
+    Other keyword arguments are passed to heapdict() for the expiry heap.
+    All methods are thread-safe, so start_sweeper() can remove expired keys
+    from a background thread."""
+
+    def __init__(self, ttl, clock=time.time, refresh=False, batch=64, **kw):
+        self.ttl = ttl
+        self.clock = clock
+        self.refresh = refresh
+        self.batch = batch
+        self.expiries = heapdict(**kw)
+        # key -> (value, ttl)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.sweeper = None
+
+    def _expired(self, key, now):
+        # Remove key if it has expired by now; the lock must be held.
+        if self.expiries[key] > now:
+            return False
+        del self.expiries[key]
+        del self.values[key]
+        return True
+
+    def _expire(self, now, limit):
+        expiries, values = self.expiries, self.values
+        if limit is None:
+            expired = expiries.pop_until(now)
+        else:
+            expired = []
+            while (len(expired) < limit and expiries
+                   and expiries.peekitem()[1] <= now):
+                expired.append(expiries.popitem())
+        for key, _ in expired:
+            del values[key]
+        return len(expired)
+
+    def expire(self, limit=None):
+        """D.expire([limit]) -> number of expired keys removed, no more than limit."""
+        with self.lock:
+            return self._expire(self.clock(), limit)
+
+    def set(self, key, value, ttl=None):
+        """D.set(k, v[, ttl]) -> None.  Set D[k] to v, expiring in ttl seconds instead of D.ttl."""
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            now = self.clock()
+            self._expire(now, self.batch)
+            self.values[key] = (value, ttl)
+            self.expiries[key] = now + ttl
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        with self.lock:
+            now = self.clock()
+            if key not in self.values or self._expired(key, now):
+                raise KeyError(key)
+            value, ttl = self.values[key]
+            if self.refresh:
+                self.expiries[key] = now + ttl
+            return value
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.values or self._expired(key, self.clock()):
+                raise KeyError(key)
+            del self.expiries[key]
+            del self.values[key]
+
+    @doc(dict.__contains__)
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.values and not self._expired(key, self.clock())
+
+    @doc(dict.__iter__)
+    def __iter__(self):
+        with self.lock:
+            now = self.clock()
+            return iter([k for k, t in self.expiries.items() if t > now])
+
+    @doc(dict.__len__)
+    def __len__(self):
+        return len(self.values)
+
+    @doc(dict.clear)
+    def clear(self):
+        with self.lock:
+            self.expiries.clear()
+            self.values.clear()
+
+    def start_sweeper(self, interval=1.0):
+        """D.start_sweeper([interval]) -> None.  Remove expired keys every interval
+seconds from a daemon thread, batch at a time, until stop_sweeper() is called."""
+        if self.sweeper is not None:
+            raise RuntimeError('the sweeper is already running')
+        stopped = threading.Event()
+
+        def sweep():
+            while not stopped.wait(interval):
+                # Release the lock between batches.
+                while self.expire(self.batch) == self.batch:
+                    pass
+        self.sweeper = threading.Thread(target=sweep, name='ExpiringDict sweeper')
+        self.sweeper.daemon = True
+        self.stopped = stopped
+        self.sweeper.start()
+
+    def stop_sweeper(self):
+        """D.stop_sweeper() -> None.  Stop the thread started by start_sweeper()."""
+        if self.sweeper is not None:
+            self.stopped.set()
+            self.sweeper.join()
+            self.sweeper = None
+
+
+class RecordingHeapDict(MutableMapping):
+    """A heapdict that writes a trace of its operations to a file.
+
+    Each __setitem__, __delitem__, popitem and peekitem call is written to
+    file, a binary file open for writing, as a record of at most 13 bytes,
+    and read_trace() reads them back; bench_heap.py --trace replays a trace
+    against any heapdict configuration. Keys are written as integer ids, an
+    id being reused once its key is removed, so a trace keeps the pattern of
+    operations but not the keys. Priorities must be ints or floats. Other
+    arguments are passed to heapdict() to make the heap. Batch methods are
+    recorded as the single operations they amount to, and file is left for
+    the caller to close."""
+
+    def _check_invariants(self):
+        self.h._check_invariants()
+
+    def __init__(self, file, *args, **kw):
+        self.file = file
+        self.h = heapdict(*args, **kw)
+        self.ids = {}
+        self.free = []
+        file.write(_TRACE_MAGIC)
+        for key, value in self.h.items():
+            self.ids[key] = len(self.ids)
+            file.write(_trace_set(self.ids[key], value))
+
+    def _release(self, key):
+        self.free.append(self.ids.pop(key))
+
+    @doc(dict.clear)
+    def clear(self):
+        while self.h:
+            self.popitem()
+
+    @doc(dict.__setitem__)
+    def __setitem__(self, key, value):
+        # Nothing is changed or written unless both the record and the
+        # change can be made.
+        i = self.ids.get(key)
+        new = i is None
+        if new:
+            i = self.free[-1] if self.free else len(self.ids)
+        record = _trace_set(i, value)
+        self.h[key] = value
+        if new:
+            self.ids[key] = self.free.pop() if self.free else i
+        self.file.write(record)
+
+    @doc(dict.__delitem__)
+    def __delitem__(self, key):
+        del self.h[key]
+        self.file.write(_TRACE_RECORDS[b'd'][1].pack(b'd', self.ids[key]))
+        self._release(key)
+
+    @doc(dict.__getitem__)
+    def __getitem__(self, key):
+        return self.h[key]
+
+    @doc(dict.__contains__)
+    def __contains__(self, key):
+        return key in self.h
+
+    @doc(dict.__iter__)
+    def __iter__(self):
+        return iter(self.h)
+
+    @doc(dict.__len__)
+    def __len__(self):
+        return len(self.h)
+
+    @doc(heapdict.pop)
+    def pop(self, *args):
+        if not args:
+            return self.popitem()[0]
+        return super(RecordingHeapDict, self).pop(*args)
+
+    @doc(heapdict.popitem)
+    def popitem(self):
+        # A failed pop is recorded too, so that replaying it fails alike.
+        self.file.write(b'p')
+        item = self.h.popitem()
+        self._release(item[0])
+        return item
+
+    @doc(heapdict.peekitem)
+    def peekitem(self):
+        self.file.write(b'k')
+        return self.h.peekitem()
+
+    @doc(heapdict.popmany)
+    def popmany(self, n):
+        return [self.popitem() for _ in xrange(min(n, len(self.h)))]
+
+    @doc(heapdict.pop_until)
+    def pop_until(self, threshold):
+        items = []
+        while self.h and self.peekitem()[1] <= threshold:
+            items.append(self.popitem())
+        return items
+
+    @doc(heapdict.nsmallest)
+    def nsmallest(self, n):
+        return self.h.nsmallest(n)
+
+    @doc(heapdict.iter_sorted)
+    def iter_sorted(self):
+        return self.h.iter_sorted()
+
+    @doc(heapdict.count_below)
+    def count_below(self, x):
+        return self.h.count_below(x)
+
+    @doc(heapdict.items_below)
+    def items_below(self, x):
+        return self.h.items_below(x)
+
+    @doc(heapdict.items_in_range)
+    def items_in_range(self, a, b):
+        return self.h.items_in_range(a, b)
+
+    @doc(heapdict.transaction)
+    def transaction(self):
+        return _Transaction(self, getattr(self.h, '_sortkey', None))
+
+    def _commit(self, values, deleted):
+        # Through self, so that the trace records each change.
+        for key in deleted:
+            if key in self:
+                del self[key]
+        self.update(values)
+
+
+def read_trace(file):
+    """Yield the (op, id, priority) records of a trace written by RecordingHeapDict
+    to file, a binary file, where op is 'set', 'del', 'pop' or 'peek', id is
+    the key's integer id or None, and priority is None except for 'set'."""
+    if file.read(len(_TRACE_MAGIC)) != _TRACE_MAGIC:
+        raise ValueError('not a heapdict trace')
+    buf = b''
+    while True:
+        chunk = file.read(1 << 16)
+        if not chunk:
+            break
+        buf += chunk
+        i, n = 0, len(buf)
+        while i < n:
+            try:
+                op, record = _TRACE_RECORDS[buf[i:i + 1]]
+            except KeyError:
+                raise ValueError('corrupt heapdict trace')
+            if i + record.size > n:
+                break
+            fields = record.unpack_from(buf, i)
+            i += record.size
+            yield (op, fields[1] if len(fields) > 1 else None,
+                   fields[2] if len(fields) > 2 else None)
+        buf = buf[i:]
+    if buf:
+        raise ValueError('truncated heapdict trace')
+
+
 del doc
-__all__ = ['heapdict']
+__all__ = ['heapdict', 'CompactHeapDict', 'LazyHeapDict', 'PairingHeapDict',
+           'RadixHeapDict', 'CalendarHeapDict', 'InstrumentedHeapDict',
+           'NumpyHeapDict', 'SortedHeapDict', 'AutoHeapDict', 'KeyedHeapDict',
+           'BlockingHeapDict', 'ExpiringDict', 'RecordingHeapDict',
+           'read_trace', 'peek']
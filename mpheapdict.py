@@ -0,0 +1,273 @@
+"""A heapdict sharded across worker processes, to use more than one core."""
+import itertools
+import multiprocessing
+from operator import itemgetter
+try:
+    # Python 3
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
+
+from heapdict import heapdict
+
+
+def _serve(conn, options):
+    # The loop run by each worker process: apply each (name, args) command
+    # to the worker's own heapdict and reply with (ok, result, first, size),
+    # where first is its first (key, value) pair or None, until sent None.
+    h = heapdict(**options)
+    while True:
+        command = conn.recv()
+        if command is None:
+            break
+        name, args = command
+        try:
+            if name == 'keys':
+                result = list(h)
+            else:
+                result = getattr(h, name)(*args)
+            ok = True
+        except Exception as e:
+            result, ok = e, False
+        conn.send((ok, result, h.peekitem() if h else None, len(h)))
+    conn.close()
+
+
+class ShardedHeapDict(MutableMapping):
+    """A heapdict whose items are split across worker processes by key hash.
+
+    Each of the shards worker processes, by default one per CPU, owns a
+    heapdict made with options, and every key lives in shard hash(key) %
+    shards. Each reply from a shard also carries its size and first item,
+    which are kept in self.sizes and in self.tops, a heapdict of shard
+    numbers ordered by their first priorities, so len(), peekitem() and
+    choosing the shard for popitem() need no extra messages. A single
+    operation costs a round trip through a pipe, tens of times more than a
+    local heapdict operation, so the gain is in the batch methods: update(),
+    popmany(), pop_until(), nsmallest() and the range queries send one
+    message to each shard and let them all work at once. Keys and
+    priorities must be picklable. close() stops the workers, after which
+    every method raises ValueError; the instance is also a context
+    manager."""
+
+    def __init__(self, items=(), shards=None, **options):
+        if options.get('maxsize') is not None:
+            raise ValueError('a sharded heapdict does not support maxsize')
+        self.key = options.get('key')
+        self.reverse = options.get('reverse', False)
+        heapdict(**options)  # raises for bad options here, not in a worker.
+        self.closed = False
+        self.conns = []
+        self.processes = []
+        for i in range(shards or multiprocessing.cpu_count()):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve,
+                                              args=(child, options))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+        self.sizes = [0] * len(self.conns)
+        self.tops = heapdict(key=self.key, reverse=self.reverse)
+        self.firsts = [None] * len(self.conns)
+        self.update(items)
+
+    def _check_invariants(self):
+        self._call_all('_check_invariants')
+        for i, first in enumerate(self.firsts):
+            assert (first is None) == (i not in self.tops)
+            assert first is None or self.tops[i] == first[1]
+        self.tops._check_invariants()
+
+    def close(self):
+        """D.close() -> None.  Stop the worker processes; D can't be used
+after."""
+        for conn in self.conns:
+            conn.send(None)
+            conn.close()
+        for process in self.processes:
+            process.join()
+        del self.conns[:]
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError('heap is closed')
+
+    def _shard(self, key):
+        self._check_open()
+        return hash(key) % len(self.conns)
+
+    def _receive(self, i):
+        # Read shard i's reply, note its size and first item, and return the
+        # result or the exception it raised.
+        ok, result, first, size = self.conns[i].recv()
+        self.sizes[i] = size
+        self.firsts[i] = first
+        if first is None:
+            self.tops.pop(i, None)
+        else:
+            self.tops[i] = first[1]
+        return result if ok else _Failed(result)
+
+    def _call(self, i, name, *args):
+        self.conns[i].send((name, args))
+        result = self._receive(i)
+        if isinstance(result, _Failed):
+            raise result.exception
+        return result
+
+    def _call_each(self, calls):
+        # Send each shard i in calls its (name, args) command before reading
+        # any reply, so that the shards work at the same time, and return
+        # the results as a list. Every reply is read before raising.
+        self._check_open()
+        for i, command in calls.items():
+            self.conns[i].send(command)
+        results = [self._receive(i) for i in calls]
+        for result in results:
+            if isinstance(result, _Failed):
+                raise result.exception
+        return results
+
+    def _call_all(self, name, *args):
+        return self._call_each(dict((i, (name, args))
+                                    for i in range(len(self.conns))))
+
+    def _sorted(self, lists, by_value=False):
+        # Merge lists of (key, value) pairs into priority order, or into
+        # increasing value order if by_value.
+        key = None if by_value else self.key
+        order = itemgetter(1) if key is None else lambda item: key(item[1])
+        return sorted(itertools.chain.from_iterable(lists), key=order,
+                      reverse=self.reverse and not by_value)
+
+    def clear(self):
+        self._call_all('clear')
+
+    clear.__doc__ = dict.clear.__doc__
+
+    def __setitem__(self, key, value):
+        self._call(self._shard(key), '__setitem__', key, value)
+
+    __setitem__.__doc__ = dict.__setitem__.__doc__
+
+    def __delitem__(self, key):
+        self._call(self._shard(key), '__delitem__', key)
+
+    __delitem__.__doc__ = dict.__delitem__.__doc__
+
+    def __getitem__(self, key):
+        return self._call(self._shard(key), '__getitem__', key)
+
+    __getitem__.__doc__ = dict.__getitem__.__doc__
+
+    def __contains__(self, key):
+        return self._call(self._shard(key), '__contains__', key)
+
+    __contains__.__doc__ = dict.__contains__.__doc__
+
+    def __iter__(self):
+        keys = self._call_all('keys')
+        return iter(list(itertools.chain.from_iterable(keys)))
+
+    __iter__.__doc__ = dict.__iter__.__doc__
+
+    def __len__(self):
+        self._check_open()
+        return sum(self.sizes)
+
+    __len__.__doc__ = dict.__len__.__doc__
+
+    def update(self, *args, **kw):
+        parts = {}
+        for key, value in dict(*args, **kw).items():
+            parts.setdefault(self._shard(key), {})[key] = value
+        self._call_each(dict((i, ('update', (part,)))
+                             for i, part in parts.items()))
+
+    update.__doc__ = heapdict.update.__doc__
+    push_many = update
+
+    def bump(self, key, amount=1, default=None):
+        return self._call(self._shard(key), 'bump', key, amount, default)
+
+    bump.__doc__ = heapdict.bump.__doc__
+
+    def pop(self, *args):
+        if not args:
+            return self.popitem()[0]
+        return self._call(self._shard(args[0]), 'pop', *args)
+
+    pop.__doc__ = heapdict.pop.__doc__
+
+    def popitem(self):
+        self._check_open()
+        if not self.tops:
+            raise IndexError('popitem(): heapdict is empty')
+        return self._call(self.tops.peekitem()[0], 'popitem')
+
+    popitem.__doc__ = heapdict.popitem.__doc__
+
+    def peekitem(self):
+        self._check_open()
+        if not self.tops:
+            raise IndexError('peekitem(): heapdict is empty')
+        return self.firsts[self.tops.peekitem()[0]]
+
+    peekitem.__doc__ = heapdict.peekitem.__doc__
+
+    def nsmallest(self, n):
+        return self._sorted(self._call_all('nsmallest', n))[:max(n, 0)]
+
+    nsmallest.__doc__ = heapdict.nsmallest.__doc__
+
+    def popmany(self, n):
+        # Find how many of the first n items each shard holds, then pop
+        # that many from each.
+        counts = {}
+        for key, _ in self.nsmallest(n):
+            i = self._shard(key)
+            counts[i] = counts.get(i, 0) + 1
+        return self._sorted(self._call_each(
+            dict((i, ('popmany', (count,))) for i, count in counts.items())))
+
+    popmany.__doc__ = heapdict.popmany.__doc__
+
+    def pop_until(self, threshold):
+        return self._sorted(self._call_all('pop_until', threshold))
+
+    pop_until.__doc__ = heapdict.pop_until.__doc__
+
+    def count_below(self, x):
+        return sum(self._call_all('count_below', x))
+
+    count_below.__doc__ = heapdict.count_below.__doc__
+
+    def items_below(self, x):
+        return self._sorted(self._call_all('items_below', x), True)
+
+    items_below.__doc__ = heapdict.items_below.__doc__
+
+    def items_in_range(self, a, b):
+        return self._sorted(self._call_all('items_in_range', a, b), True)
+
+    items_in_range.__doc__ = heapdict.items_in_range.__doc__
+
+
+class _Failed(object):
+    # An exception raised in a shard, to be raised once every reply is read.
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+__all__ = ['ShardedHeapDict']
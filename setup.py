@@ -17,7 +17,7 @@ setup(name='HeapDict',
       license = "BSD",
       keywords = "heap decrease-key increase-key dictionary Dijkstra A* priority queue",
       provides = ['heapdict'],
-      py_modules = ['heapdict'],
+      py_modules = ['heapdict', 'mpheapdict'] + (['aioheapdict'] if sys.version_info >= (3, 7) else []),
       test_suite = "test_heap",
       zip_safe = True,
       classifiers = [
@@ -1,33 +1,64 @@
 #!/usr/bin/python
 from __future__ import print_function
+import copy
+import io
+import operator
+import pickle
 import random
 import sys
-import unittest
-import timeit
 import tempfile
-from heapdict import heapdict
+import threading
+import time
+import unittest
+from heapdict import heapdict, CompactHeapDict, LazyHeapDict, PairingHeapDict
+from heapdict import RadixHeapDict, CalendarHeapDict, InstrumentedHeapDict
+from heapdict import NumpyHeapDict, SortedHeapDict, AutoHeapDict, KeyedHeapDict
+from heapdict import BlockingHeapDict, ExpiringDict
+from heapdict import RecordingHeapDict, read_trace, peek
+from mpheapdict import ShardedHeapDict
 try:
     # Python 3
     import test.support as test_support
 except ImportError:
     # Python 2
     import test.test_support as test_support
+if sys.version_info >= (3, 7):
+    import asyncio
+    from aioheapdict import AsyncHeapDict
+else:
+    AsyncHeapDict = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 N = 100
 
 
 class TestHeap(unittest.TestCase):
+    """Conformance tests that every heapdict engine and storage must pass.
+
+    Subclasses set options to the heapdict() arguments selecting one."""
+
+    options = {}
+
+    def heapdict(self, *args, **kw):
+        kw.update(self.options)
+        return heapdict(*args, **kw)
+
+    def priority(self):
+        return random.random()
 
     def make_data(self):
-        pairs = [(random.random(), random.random()) for i in range(N)]
-        h = heapdict(pairs)
+        pairs = [(random.random(), self.priority()) for i in range(N)]
+        h = self.heapdict(pairs)
         d = dict(pairs)
         pairs.sort(key=lambda x: x[1], reverse=True)
         return h, pairs, d
 
     def test_pop(self):
         # verify that we raise IndexError on empty heapdict
-        empty_heap = heapdict()
+        empty_heap = self.heapdict()
         self.assertRaises(IndexError, empty_heap.pop)
         # test adding a bunch of random values at random priorities
         h, pairs, _ = self.make_data()
@@ -44,19 +75,19 @@ class TestHeap(unittest.TestCase):
         self.assertEqual(len(h), 0)
         # now verify that we raise KeyError if we try to remove something
         # by key that is not present
-        empty_heap = heapdict()
+        empty_heap = self.heapdict()
         self.assertRaises(KeyError, empty_heap.pop, "missing")
         # verify that we do *not* get a KeyError if we specify a default
-        empty_heap = heapdict()
+        empty_heap = self.heapdict()
         self.assertEqual(empty_heap.pop("missing", 123), 123)
         # confirm that we can get a value by key if it is present
-        h = heapdict()
+        h = self.heapdict()
         h["foo"] = 10
         self.assertEqual(len(h), 1)
         self.assertEqual(h.pop("foo"), 10)
         self.assertEqual(len(h), 0)
         # verify that removing keys does the right thing to a heap
-        h = heapdict()
+        h = self.heapdict()
         h["c"] = 30
         h["a"] = 10
         h["b"] = 20
@@ -75,7 +106,7 @@ class TestHeap(unittest.TestCase):
         self.assertEqual(len(h), 0)
 
     def test_popitem_ties(self):
-        h = heapdict()
+        h = self.heapdict()
         for i in range(N):
             h[i] = 0
         for i in range(N):
@@ -117,8 +148,8 @@ class TestHeap(unittest.TestCase):
     def test_change(self):
         h, pairs, _ = self.make_data()
         k, v = pairs[N//2]
-        h[k] = 0.5
-        pairs[N//2] = (k, 0.5)
+        h[k] = p = self.priority()
+        pairs[N//2] = (k, p)
         pairs.sort(key=lambda x: x[1], reverse=True)
         while pairs:
             v = h.popitem()
@@ -131,9 +162,1321 @@ class TestHeap(unittest.TestCase):
         h.clear()
         self.assertEqual(len(h), 0)
 
+    def test_update(self):
+        # small batches are sifted in, large ones rebuild the heap.
+        for size in (1, N//2, 2*N):
+            h, pairs, d = self.make_data()
+            batch = [(random.choice(pairs)[0], self.priority())
+                     for i in range(size//2)]
+            batch += [(random.random(), self.priority()) for i in range(size//2)]
+            p = self.priority()
+            h.update(batch, extra=p)
+            d.update(batch, extra=p)
+            h._check_invariants()
+            self.assertEqual(dict(h), d)
+            d['new'] = self.priority()
+            h.push_many({'new': d['new']})
+            expected = sorted(d.items(), key=lambda x: x[1])
+            self.assertEqual([h.popitem() for i in range(len(h))], expected)
+
+    def test_popmany(self):
+        for n in (0, 1, N//2, N, 2*N):
+            pairs = [(random.random(), self.priority()) for i in range(N)]
+            h = self.heapdict(pairs)
+            pairs.sort(key=lambda x: x[1])
+            self.assertEqual(h.popmany(n), pairs[:n])
+            h._check_invariants()
+            self.assertEqual(sorted(h.items()), sorted(pairs[n:]))
+
+    def test_nsmallest(self):
+        pairs = [(random.random(), self.priority()) for i in range(N)]
+        h = self.heapdict(pairs)
+        for i, (k, _) in enumerate(pairs[:N//4]):
+            h[k] = self.priority() * 2
+            h[k] = self.priority()
+            pairs[i] = (k, h[k])
+        pairs.sort(key=lambda x: x[1])
+        for n in (0, 1, N//2, N, 2*N):
+            self.assertEqual(h.nsmallest(n), pairs[:n])
+        self.assertEqual(len(h), N)
+        h._check_invariants()
+
+    def test_iter_sorted(self):
+        h, pairs, d = self.make_data()
+        expected = sorted(d.items(), key=lambda x: x[1])
+        items = h.iter_sorted()
+        self.assertEqual([next(items) for i in range(5)], expected[:5])
+        self.assertEqual(list(items), expected[5:])
+        self.assertEqual(len(h), N)
+        h._check_invariants()
+        self.assertEqual(list(self.heapdict().iter_sorted()), [])
+        # adding a key, or moving the last one to the front, is detected
+        items = h.iter_sorted()
+        next(items)
+        h['new'] = self.priority()
+        self.assertRaises(RuntimeError, list, items)
+        del h['new']
+        items = h.iter_sorted()
+        self.assertEqual([next(items) for i in range(N//4)], expected[:N//4])
+        h[expected[-1][0]] = expected[0][1]
+        self.assertRaises(RuntimeError, list, items)
+
+    def test_copy(self):
+        h, pairs, d = self.make_data()
+        c = h.copy()
+        self.assertIs(type(c), type(h))
+        self.assertEqual(dict(c), d)
+        # changes to either side stay private to it
+        (k, _), (gone, _) = pairs[:2]
+        c[k] = p = self.priority()
+        del c[gone]
+        c['new'] = q = self.priority()
+        h['other'] = self.priority()
+        del h['other']
+        h._check_invariants()
+        c._check_invariants()
+        self.assertEqual(dict(h), d)
+        e = dict(d, new=q)
+        e[k] = p
+        del e[gone]
+        self.assertEqual(dict(c), e)
+        # copies of copies, while the original is emptied
+        c2 = h.copy()
+        c3 = copy.copy(c2)
+        expected = sorted(d.items(), key=lambda x: x[1])
+        self.assertEqual(h.popmany(N), expected)
+        self.assertEqual(c3.popmany(N//2), expected[:N//2])
+        h.clear()
+        self.assertEqual(dict(c2), d)
+        self.assertEqual(dict(pickle.loads(pickle.dumps(c2))), d)
+        # a heap whose copies are all gone writes without copying itself,
+        # even if they were changed first
+        f = self.heapdict(pairs)
+        b = f.copy()
+        b[k] = self.priority()
+        if getattr(f, '_sharers', None) is not None:
+            containers = dict(vars(f), _sharers=None)
+            del b
+            f['new'] = self.priority()
+            for name, value in vars(f).items():
+                self.assertIs(value, containers[name])
+
+    def test_copy_shares_items(self):
+        # changing a few items of a copy copies only the items they move
+        d = dict((i, self.priority()) for i in range(10 * N))
+        h = self.heapdict(d)
+        if type(h) not in (heapdict, KeyedHeapDict, InstrumentedHeapDict):
+            return
+        c = h.copy()
+        c[0] = self.priority()
+        del c[1]
+        c.popitem()
+        c['new'] = self.priority()
+        h._check_invariants()
+        c._check_invariants()
+        self.assertEqual(dict(h), d)
+        shared = sum(1 for k in c if k in h.d and c.d[k] is h.d[k])
+        self.assertGreater(shared, 9 * N)
+
+    def test_copy_pop_until(self):
+        # pop_until() on a copy, taking both the pop and the rebuild paths
+        for fraction in (0.05, 0.95):
+            h, pairs, d = self.make_data()
+            c = h.copy()
+            threshold = pairs[int((1 - fraction) * (N - 1))][1]
+            expected = sorted(p for p in d.items() if p[1] <= threshold)
+            self.assertEqual(sorted(h.pop_until(threshold)), expected)
+            h._check_invariants()
+            c._check_invariants()
+            self.assertEqual(dict(c), d)
+            self.assertEqual(len(h), N - len(expected))
+            self.assertEqual(sorted(h.popmany(N)),
+                             sorted(p for p in d.items() if p[1] > threshold))
+
+    def test_merge(self):
+        policies = [(min, min), (max, max), ('self', lambda a, b: a),
+                    ('other', lambda a, b: b)]
+        # small and large merges take the insert and rebuild paths.
+        for size in (N//10, 2*N):
+            for conflict, resolve in policies:
+                h, other = self.heapdict(), self.heapdict()
+                d, e = {}, {}
+                for i in range(N):
+                    k = random.randrange(2*N)
+                    d[k] = h[k] = self.priority()
+                for i in range(size):
+                    k = random.randrange(2*N)
+                    e[k] = other[k] = self.priority()
+                h.merge(other, conflict)
+                for k, v in e.items():
+                    d[k] = resolve(d[k], v) if k in d else v
+                h._check_invariants()
+                self.assertEqual(dict(h), d)
+                self.assertEqual(dict(other), e)
+        h.merge({})
+        self.assertEqual(dict(h), d)
+        self.assertRaises(ValueError, h.merge, other, 'neither')
+
+    def test_peek_across(self):
+        order = {'key': self.options.get('key'),
+                 'reverse': self.options.get('reverse', False)}
+        heaps = [self.heapdict() for i in range(4)]
+        self.assertRaises(IndexError, peek, heaps, **order)
+        d = {}
+        for i in range(N):
+            d[i] = heaps[random.randrange(3)][i] = self.priority()
+        i, k, v = peek(heaps, **order)
+        self.assertEqual(v, min(d.values()))
+        self.assertEqual(heaps[i].peekitem(), (k, v))
+        for h in heaps:
+            self.assertEqual(len(h), len(h.nsmallest(N)))
+
+    def test_pop_until(self):
+        # small and large fractions take the pop and rebuild paths.
+        for fraction in (0.0, 0.05, 0.5, 1.0):
+            pairs = [(random.random(), self.priority()) for i in range(N)]
+            h = self.heapdict(pairs)
+            pairs.sort(key=lambda x: x[1])
+            threshold = pairs[int(fraction * (N - 1))][1]
+            expected = [p for p in pairs if p[1] <= threshold]
+            self.assertEqual(h.pop_until(threshold), expected)
+            h._check_invariants()
+            self.assertEqual(sorted(h.items()), sorted(pairs[len(expected):]))
+        self.assertEqual(self.heapdict().pop_until(1), [])
+
+    def test_range_queries(self):
+        h, _, d = self.make_data()
+        values = sorted(d.values())
+        for x in (values[0], values[N // 3], values[-1], values[-1] + 1):
+            expected = [(k, v) for k, v in d.items() if v < x]
+            self.assertEqual(h.count_below(x), len(expected))
+            items = h.items_below(x)
+            self.assertEqual(dict(items), dict(expected))
+            self.assertEqual(sorted(items, key=operator.itemgetter(1)), items)
+        a, b = values[N // 4], values[3 * N // 4]
+        items = h.items_in_range(a, b)
+        self.assertEqual(dict(items),
+                         dict((k, v) for k, v in d.items() if a <= v < b))
+        self.assertEqual(sorted(items, key=operator.itemgetter(1)), items)
+        self.assertEqual(h.items_in_range(b, a), [])
+        self.assertEqual(len(h), N)
+        h._check_invariants()
+        empty = self.heapdict()
+        self.assertEqual(empty.count_below(values[-1]), 0)
+        self.assertEqual(empty.items_below(values[-1]), [])
+
+    def test_transaction(self):
+        h, pairs, d = self.make_data()
+        key = pairs[-1][0]
+        with h.transaction() as t:
+            t[key] = self.priority()
+            del t[pairs[0][0]]
+            t['new'] = self.priority()
+            self.assertEqual(dict(h), d)
+            t.rollback()
+            self.assertEqual(dict(t), d)
+        self.assertEqual(dict(h), d)
+        try:
+            with h.transaction() as t:
+                del t[key]
+                raise ZeroDivisionError
+        except ZeroDivisionError:
+            pass
+        self.assertEqual(dict(h), d)
+        h._check_invariants()
+        # many changes to the same keys, read back before committing.
+        with h.transaction() as t:
+            for i in range(4 * N):
+                k = random.randrange(N // 2)
+                if random.random() < 0.3:
+                    t.pop(pairs[k][0], None)
+                    d.pop(pairs[k][0], None)
+                else:
+                    t[pairs[k][0]] = d[pairs[k][0]] = self.priority()
+                self.assertEqual(len(t), len(d))
+            self.assertEqual(dict(t), d)
+            self.assertEqual(len(h), N)
+            values = sorted(d.values())
+            self.assertEqual([v for k, v in t.nsmallest(10)], values[:10])
+            self.assertEqual(t.peekitem()[1], values[0])
+            k, v = t.popitem()
+            self.assertEqual(v, values[0])
+            self.assertNotIn(k, t)
+            del d[k]
+        self.assertEqual(dict(h), d)
+        h._check_invariants()
+        # a key the transaction deletes is removed from h directly first
+        k, v = h.popitem()
+        gone = random.choice(list(h))
+        with h.transaction() as t:
+            del t[gone]
+            t[k] = v
+            del h[gone]
+        del d[gone]
+        self.assertEqual(dict(h), d)
+        h._check_invariants()
+        self.assertRaises(IndexError, self.heapdict().transaction().popitem)
+
+    def test_bump(self):
+        h, pairs, d = self.make_data()
+        key = pairs[-1][0]
+        self.assertEqual(h.bump(key), d[key] + 1)
+        self.assertEqual(h[key], d[key] + 1)
+        self.assertEqual(h.bump(key, 2), d[key] + 3)
+        self.assertIsNone(h.bump('missing'))
+        self.assertEqual(h.bump('missing', 1, 0), 0)
+        self.assertNotIn('missing', h)
+        h._check_invariants()
+
+    def test_pickle(self):
+        h, pairs, d = self.make_data()
+        for key, _ in pairs[:N//4]:
+            d[key] = h[key] = self.priority()
+        expected = sorted(d.items(), key=lambda x: x[1])
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(h, protocol))
+            self.assertIs(type(copy), type(h))
+            copy._check_invariants()
+            self.assertEqual(dict(copy), d)
+        copy['new'] = self.priority()
+        copy._check_invariants()
+        del copy['new']
+        self.assertEqual([copy.popitem() for i in range(N)], expected)
+
+    def test_snapshot(self):
+        pairs = [(random.random(), self.priority()) for i in range(N)]
+        h = heapdict(pairs, **self.options)
+        f = tempfile.TemporaryFile()
+        h.dump(f)
+        expected = sorted(pairs, key=lambda x: x[1])
+        for options in (self.options, {}, {'arity': 3}, {'engine': 'pairing'}):
+            f.seek(0)
+            copy = heapdict.load(f, **options)
+            copy._check_invariants()
+            self.assertEqual(copy.nsmallest(N), expected)
+        # a heap comes back in the same order, without sifting
+        f.seek(0)
+        copy = heapdict.load(f, **self.options)
+        if h._value == 0:
+            self.assertEqual(copy._heap_order(), h._heap_order())
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_errors(self):
+        f = tempfile.TemporaryFile()
+        self.assertRaises(TypeError, heapdict({'a': 'x'}).dump, f)
+        self.assertRaises(ValueError, heapdict.load, f)
+        f.write(b'not a heapdict snapshot')
+        f.seek(0)
+        self.assertRaises(ValueError, heapdict.load, f)
+
+    def test_large_ints(self):
+        # ints beyond 8 bytes are pickled rather than overflowing
+        d = dict((i, random.randrange(2**70)) for i in range(N))
+        h = heapdict(d)
+        f = tempfile.TemporaryFile()
+        h.dump(f)
+        for options in ({}, {'engine': 'pairing'}):
+            f.seek(0)
+            copy = heapdict.load(f, **options)
+            copy._check_invariants()
+            self.assertEqual(dict(copy), d)
+        f.seek(0)
+        self.assertEqual(heapdict.load(f)._heap_order(), h._heap_order())
+
+    def test_wide_arity(self):
+        d = dict((i, random.random()) for i in range(N))
+        for arity in (300, 2 ** 32):
+            h = heapdict(d, arity=arity)
+            f = tempfile.TemporaryFile()
+            h.dump(f)
+            f.seek(0)
+            copy = heapdict.load(f, arity=arity)
+            copy._check_invariants()
+            self.assertEqual(dict(copy), d)
+            if arity < 2 ** 32:
+                self.assertEqual(copy._heap_order(), h._heap_order())
+
+
+class TestDaryHeap(TestHeap):
+
+    options = {'arity': 3}
+
+    def test_arity(self):
+        self.assertRaises(ValueError, heapdict, arity=1)
+        for arity in (2, 3, 4, 8):
+            pairs = [(random.random(), random.random()) for i in range(N)]
+            h = heapdict(pairs, arity=arity)
+            self.assertEqual(h.arity, arity)
+            h._check_invariants()
+            d = dict(pairs)
+            for k in list(d)[:N//4]:
+                d[k] = h[k] = random.random()
+                h._check_invariants()
+            for k in list(d)[N//4:N//2]:
+                del d[k]
+                del h[k]
+                h._check_invariants()
+            h['new'] = d['new'] = 0.5
+            h._check_invariants()
+            expected = sorted(d.items(), key=lambda x: x[1])
+            self.assertEqual([h.popitem() for i in range(len(h))], expected)
+
+
+class TestCompactHeap(TestHeap):
+
+    options = {'storage': 'compact'}
+
+    def test_storage(self):
+        self.assertRaises(ValueError, heapdict, storage='bogus')
+        self.assertIs(type(heapdict(storage='list')), heapdict)
+        h = heapdict(storage='compact')
+        self.assertIsInstance(h, CompactHeapDict)
+        self.assertNotIn('storage', h)
+
+    def test_operations(self):
+        for arity in (2, 4):
+            pairs = [(random.random(), random.random()) for i in range(N)]
+            h = heapdict(pairs, storage='compact', arity=arity)
+            h._check_invariants()
+            d = dict(pairs)
+            self.assertEqual(dict(h), d)
+            for k in list(d)[:N//4]:
+                d[k] = h[k] = random.random()
+                h._check_invariants()
+            for k in list(d)[N//4:N//2]:
+                self.assertEqual(h.pop(k), d.pop(k))
+                h._check_invariants()
+            h['new'] = d['new'] = 0.5
+            h._check_invariants()
+            for size in (2, 2*N):
+                batch = [(random.choice(list(d)), random.random())
+                         for i in range(size//2)]
+                batch += [(random.random(), random.random())
+                          for i in range(size//2)]
+                h.update(batch)
+                d.update(batch)
+                h._check_invariants()
+                self.assertEqual(dict(h), d)
+            k, v = h.peekitem()
+            self.assertEqual(v, min(d.values()))
+            expected = sorted(d.items(), key=lambda x: x[1])
+            self.assertEqual([h.popitem() for i in range(len(h))], expected)
+            self.assertRaises(IndexError, h.pop)
+            self.assertRaises(KeyError, h.pop, 'missing')
+            h['a'] = 1
+            h.clear()
+            self.assertEqual(len(h), 0)
+
+
+class TestLazyHeap(TestHeap):
+
+    options = {'engine': 'lazy'}
+
+    def test_engine(self):
+        self.assertRaises(ValueError, heapdict, engine='bogus')
+        self.assertRaises(ValueError, heapdict, engine='lazy', storage='compact')
+        self.assertRaises(ValueError, heapdict, engine='lazy', arity=4)
+        h = heapdict(engine='lazy')
+        self.assertIsInstance(h, LazyHeapDict)
+        self.assertNotIn('engine', h)
+
+    def test_operations(self):
+        pairs = [(random.random(), random.random()) for i in range(N)]
+        h = heapdict(pairs, engine='lazy')
+        d = dict(pairs)
+        for k in list(d)[:N//2]:
+            d[k] = h[k] = random.random()
+            h._check_invariants()
+        for k in list(d)[N//2:3*N//4]:
+            del d[k]
+            del h[k]
+            h._check_invariants()
+        self.assertEqual(dict(h), d)
+        self.assertEqual(h.peekitem(), min(d.items(), key=lambda x: x[1]))
+        expected = sorted(d.items(), key=lambda x: x[1])
+        self.assertEqual([h.popitem() for i in range(len(h))], expected)
+        self.assertRaises(IndexError, h.popitem)
+        self.assertRaises(IndexError, h.peekitem)
+
+    def test_garbage_bound(self):
+        for max_garbage in (0, 0.5, 2.0):
+            h = heapdict(((i, i) for i in range(N)), engine='lazy',
+                         max_garbage=max_garbage)
+            for i in range(10 * N):
+                h[i % N] = random.random()
+                self.assertLessEqual(h.garbage, max_garbage * N)
+                self.assertEqual(len(h.heap), N + h.garbage)
+            h._check_invariants()
+            for i in range(N):
+                del h[i]
+            self.assertEqual(len(h), 0)
+            self.assertLessEqual(len(h.heap), 1)
+        self.assertRaises(ValueError, heapdict, engine='lazy', max_garbage=-1)
+        self.assertRaises(TypeError, heapdict, {'a': 1}, engine='pairing',
+                          max_garbage=2)
+        self.assertRaises(TypeError, heapdict, max_garbage=2)
+        self.assertEqual(dict(heapdict({'a': 1}, max_garbage=None)), {'a': 1})
+
+    def test_ties(self):
+        h = heapdict(engine='lazy')
+        for i in range(N):
+            h[i] = 0
+        # equal priorities pop in insertion order without comparing keys.
+        h[object()] = 0
+        self.assertEqual([h.popitem()[0] for i in range(N)], list(range(N)))
+
+
+class TestPairingHeap(TestHeap):
+
+    options = {'engine': 'pairing'}
+
+    def test_engine(self):
+        self.assertRaises(ValueError, heapdict, engine='pairing', arity=4)
+        self.assertIsInstance(heapdict(engine='pairing'), PairingHeapDict)
+
+    def test_operations(self):
+        h = heapdict(engine='pairing')
+        d = {}
+        for i in range(10 * N):
+            k = random.randrange(N)
+            op = random.random()
+            if op < 0.6:
+                d[k] = h[k] = random.random()
+            elif op < 0.8 and k in d:
+                del d[k]
+                del h[k]
+            elif d:
+                k, v = h.popitem()
+                self.assertEqual(v, min(d.values()))
+                del d[k]
+            h._check_invariants()
+            self.assertEqual(dict(h), d)
+
+
+class TestRadixHeap(TestHeap):
+
+    options = {'engine': 'radix'}
+
+    def priority(self):
+        return random.randrange(2**40)
+
+    def test_engine(self):
+        self.assertIsInstance(heapdict(engine='radix'), RadixHeapDict)
+        self.assertRaises(ValueError, heapdict, engine='radix', arity=4)
+        self.assertRaises(ValueError, heapdict, {'a': -1}, engine='radix')
+        self.assertRaises(TypeError, heapdict, {'a': 0.5}, engine='radix')
+
+    def test_rejected(self):
+        h = heapdict({'a': 3, 'b': 5}, engine='radix')
+        self.assertEqual(h.popitem(), ('a', 3))
+        self.assertRaises(TypeError, h.__setitem__, 'b', 6.0)
+        self.assertRaises(TypeError, h.__setitem__, 'b', None)
+        self.assertRaises(ValueError, h.__setitem__, 'b', 2)
+        self.assertEqual(dict(h), {'b': 5})
+        h._check_invariants()
+        self.assertEqual(h.popitem(), ('b', 5))
+
+    def test_monotone(self):
+        h = heapdict(engine='radix')
+        d = {}
+        now = 0
+        # a Dijkstra-like workload that only schedules at or after now.
+        for i in range(10 * N):
+            k = random.randrange(N)
+            if random.random() < 0.7:
+                d[k] = h[k] = now + random.randrange(1000)
+            elif d:
+                k, now = h.popitem()
+                self.assertEqual(now, min(d.values()))
+                del d[k]
+                self.assertRaises(ValueError, h.__setitem__, 'x', now - 1)
+            h._check_invariants()
+            self.assertEqual(dict(h), d)
+        h.clear()
+        h['x'], h['y'] = now, now + 1
+        self.assertEqual(h.pop_until(now), [('x', now)])
+        # clear() forgets the last popped priority.
+        h.clear()
+        h['x'] = 0
+
+
+class TestCalendarHeap(TestHeap):
+
+    options = {'engine': 'calendar', 'width': 0.05}
+
+    def test_engine(self):
+        self.assertIsInstance(heapdict(engine='calendar'), CalendarHeapDict)
+        self.assertRaises(ValueError, heapdict, engine='calendar', width=0)
+        self.assertRaises(ValueError, heapdict, engine='calendar', width=-1)
+        self.assertRaises(TypeError, heapdict, width=0.5)
+        self.assertRaises(TypeError, heapdict, engine='lazy', width=0.5)
+        self.assertEqual(dict(heapdict({'a': 1}, width=None)), {'a': 1})
+
+    def test_reschedule(self):
+        h = heapdict(engine='calendar', width=0.1)
+        d = {}
+        now = 0.0
+        for i in range(10 * N):
+            k = random.randrange(N)
+            if random.random() < 0.7:
+                d[k] = h[k] = now + random.random()
+            elif d:
+                now += 0.1
+                due = sorted((p for p in d.items() if p[1] <= now),
+                             key=lambda x: x[1])
+                self.assertEqual(h.pop_until(now), due)
+                for k, _ in due:
+                    del d[k]
+            h._check_invariants()
+            self.assertEqual(dict(h), d)
+        # empty buckets are only kept until they reach the front.
+        h.clear()
+        h['a'], h['b'] = 0.0, 10.0
+        h['a'] = 5.0
+        self.assertEqual(h.popitem(), ('a', 5.0))
+        self.assertNotIn(0, h.buckets)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestNumpyHeap(TestHeap):
+
+    options = {'engine': 'numpy'}
+
+    def test_engine(self):
+        self.assertIsInstance(heapdict(engine='numpy'), NumpyHeapDict)
+        self.assertRaises(ValueError, heapdict, engine='numpy', arity=4)
+        self.assertRaises(ValueError, heapdict, {'a': 'x'}, engine='numpy')
+        h = heapdict({'a': 1}, engine='numpy')
+        self.assertIs(type(h['a']), float)
+
+    def test_update_many(self):
+        for size in (0, 1, N//10, 10*N):
+            h = self.heapdict()
+            d = {}
+            for i in range(N//2):
+                d[i] = h[i] = random.random()
+            keys = [random.randrange(N) for i in range(size)]
+            values = numpy.random.random(size)
+            h.update_many(keys, values)
+            d.update(zip(keys, values.tolist()))
+            h._check_invariants()
+            self.assertEqual(dict(h), d)
+            self.assertEqual(h.popmany(len(d)),
+                             sorted(d.items(), key=lambda x: x[1]))
+        self.assertRaises(ValueError, h.update_many, ['a'], [1, 2])
+
+    def test_heapify(self):
+        h = self.heapdict()
+        for i in range(10 * N):
+            h[i] = random.random()
+        # scramble the arrays behind the heap's back, then repair them
+        order = numpy.random.permutation(h.n)
+        h.priorities[:h.n], h.heap[:h.n] = h.priorities[order], h.heap[order]
+        d = dict((h.slotkeys[s], v) for s, v in
+                 zip(h.heap[:h.n].tolist(), h.priorities[:h.n].tolist()))
+        h.heapify()
+        h._check_invariants()
+        self.assertEqual(dict(h), d)
+
+    def test_batch_pops(self):
+        for k in (1, N//10, N, 20*N):
+            h = self.heapdict()
+            d = {}
+            for i in range(10 * N):
+                d[i] = h[i] = random.randrange(N)
+            items = h.popmany(k)
+            self.assertEqual([v for _, v in items],
+                             sorted(d.values())[:k])
+            for key, value in items:
+                self.assertEqual(d.pop(key), value)
+            h._check_invariants()
+            self.assertEqual(dict(h), d)
+            threshold = N // 2
+            items = h.pop_until(threshold)
+            self.assertEqual(sorted(items, key=lambda x: x[1]), items)
+            self.assertEqual(dict(items),
+                             dict((k, v) for k, v in d.items() if v <= threshold))
+            h._check_invariants()
+            # freed slots are reused
+            h.update(items)
+            self.assertEqual(len(h.slotkeys), 10 * N)
+
+
+class TestSortedHeap(TestHeap):
+
+    options = {'engine': 'sorted'}
+
+    def test_engine(self):
+        self.assertIsInstance(heapdict(engine='sorted'), SortedHeapDict)
+        self.assertRaises(ValueError, heapdict, engine='sorted', arity=4)
+
+    def test_ties(self):
+        h = heapdict(engine='sorted')
+        for i in range(N):
+            h[i] = 0
+        h[object()] = 0
+        self.assertEqual(h.pop_until(0)[:N], [(i, 0) for i in range(N)])
+
+
+class TestAutoHeap(TestHeap):
+
+    options = {'engine': 'auto'}
+
+    def test_engine(self):
+        self.assertRaises(ValueError, heapdict, engine='auto', arity=4)
+        h = heapdict(engine='auto')
+        self.assertIsInstance(h, AutoHeapDict)
+        self.assertEqual(h.engine, 'sorted')
+        h = heapdict(((i, i) for i in range(N)), engine='auto')
+        self.assertEqual(h.history, ['heap'])
+
+    def check(self, h, d):
+        h._check_invariants()
+        self.assertEqual(dict(h), d)
+
+    def test_migrations(self):
+        h = heapdict(engine='auto')
+        d = {}
+        # growing past a few hundred items leaves the sorted engine at once
+        for i in range(10 * N):
+            d[i] = h[i] = random.random()
+        self.assertEqual(h.history, ['sorted', 'heap'])
+        self.check(h, d)
+        # pushes and pops go to the lazy heap
+        for i in range(100 * N):
+            if i % 2:
+                d.pop(h.popitem()[0])
+            else:
+                d[-i] = h[-i] = random.random()
+        self.assertEqual(h.engine, 'lazy')
+        self.check(h, d)
+        # mostly changing priorities goes to the pairing heap
+        for i in range(100 * N):
+            if i % 4:
+                k = random.choice(list(d))
+                d[k] = h[k] = d[k] / 2
+            else:
+                d.pop(h.popitem()[0])
+                d[-i] = h[-i] = random.random()
+        self.assertEqual(h.engine, 'pairing')
+        self.check(h, d)
+        # monotone int priorities go to the radix heap
+        h.clear()
+        d.clear()
+        now = 0
+        for i in range(100 * N):
+            if i % 2 or len(d) < N:
+                d[i] = h[i] = now + random.randrange(1000)
+            else:
+                k, now = h.popitem()
+                self.assertEqual(now, min(d.values()))
+                del d[k]
+        self.assertEqual(h.engine, 'radix')
+        self.check(h, d)
+        # and a priority below the last popped one moves back to the heap
+        d['x'] = h['x'] = now - 1.5
+        self.assertEqual(h.engine, 'heap')
+        self.assertEqual(h.peekitem(), ('x', now - 1.5))
+        self.check(h, d)
+        self.assertEqual(h.history,
+                         ['sorted', 'heap', 'lazy', 'pairing', 'radix', 'heap'])
+        # a copy has its own engine and history
+        c = h.copy()
+        c.clear()
+        for i in range(20 * N):
+            c[i % (N // 2)] = random.random()
+        self.assertEqual(c.engine, 'sorted')
+        self.assertEqual(h.engine, 'heap')
+        self.check(h, d)
+
+
+class TestInstrumentedHeap(TestHeap):
+
+    options = {'instrument': True}
+
+    def test_construct(self):
+        self.assertIs(type(heapdict()), heapdict)
+        self.assertIs(type(heapdict(instrument=False)), heapdict)
+        self.assertIsInstance(heapdict(hook=lambda *args: None),
+                              InstrumentedHeapDict)
+        self.assertRaises(ValueError, heapdict, engine='lazy', instrument=True)
+        self.assertNotIn('instrument', heapdict(instrument=True))
+        self.assertEqual(dict(heapdict(hook=None)), {})
+        self.assertEqual(dict(heapdict(engine='lazy', hook=None)), {})
+        self.assertRaises(TypeError, LazyHeapDict, hook=len)
+        self.assertRaises(TypeError, heapdict, engine='lazy', on_evict=len)
+
+    def test_stats(self):
+        calls = []
+        h = heapdict(hook=lambda *args: calls.append(args))
+        for i in range(7):
+            h[i] = i
+        self.assertEqual(h.stats()['push'], 7)
+        self.assertEqual(h.stats()['sift_steps'], 0)
+        # 7 items make a full binary heap of depth 2.
+        h[6] = -1
+        self.assertEqual(calls[-1], ('decrease', 6, -1, 2))
+        h[6] = 10
+        self.assertEqual(calls[-1], ('increase', 6, 10, 2))
+        del h[3]
+        self.assertEqual(calls[-1][:3], ('delete', 3, 3))
+        self.assertEqual(h.popitem(), (0, 0))
+        self.assertEqual(calls[-1][:3], ('pop', 0, 0))
+        stats = h.stats()
+        self.assertEqual([stats[op] for op in
+                          ('push', 'pop', 'increase', 'decrease', 'delete')],
+                         [7, 1, 1, 1, 1])
+        self.assertEqual(stats['sift_steps'], sum(c[3] for c in calls))
+        self.assertGreaterEqual(stats['comparisons'], stats['sift_steps'])
+        h.reset_stats()
+        self.assertEqual(set(h.stats().values()), set([0]))
+
+
+class TestKeyedHeap(TestHeap):
+
+    # The negating key and reverse cancel out, leaving the usual order.
+    options = {'key': operator.neg, 'reverse': True}
+
+    def test_construct(self):
+        self.assertIs(type(heapdict(key=None, reverse=False)), heapdict)
+        self.assertIsInstance(heapdict(key=abs), KeyedHeapDict)
+        self.assertIsInstance(heapdict(reverse=True), KeyedHeapDict)
+        self.assertRaises(ValueError, heapdict, key=abs, engine='pairing')
+        self.assertRaises(ValueError, heapdict, key=abs, instrument=True)
+
+    def test_key(self):
+        calls = []
+
+        def key(p):
+            calls.append(p)
+            return p[1]
+        h = heapdict(key=key)
+        for i in range(N):
+            h[i] = (str(i), -i)
+        self.assertEqual(len(calls), N)
+        h[5] = ('five', N)
+        self.assertEqual(len(calls), N + 1)
+        self.assertEqual(h[5], ('five', N))
+        h._check_invariants()
+        self.assertEqual(h.peekitem(), (N - 1, (str(N - 1), 1 - N)))
+        self.assertEqual(h.nsmallest(2), [(N - 1, (str(N - 1), 1 - N)),
+                                          (N - 2, (str(N - 2), 2 - N))])
+        self.assertEqual(h.pop_until((None, 3 - N)), [
+            (N - 1, (str(N - 1), 1 - N)), (N - 2, (str(N - 2), 2 - N)),
+            (N - 3, (str(N - 3), 3 - N))])
+        self.assertEqual(h.popmany(N)[-1], (5, ('five', N)))
+        self.assertEqual(len(calls), N + 2)
+
+    def test_reverse(self):
+        pairs = [(random.random(), random.random()) for i in range(N)]
+        h = heapdict(pairs, reverse=True)
+        pairs.sort(key=lambda x: x[1], reverse=True)
+        self.assertEqual(h.nsmallest(N), pairs)
+        h.update((k, p / 2) for k, p in pairs[:N//2])
+        pairs[:N//2] = [(k, p / 2) for k, p in pairs[:N//2]]
+        pairs.sort(key=lambda x: x[1], reverse=True)
+        self.assertEqual([h.popitem() for i in range(N)], pairs)
+        # sort keys that can't be negated, and ints beyond a float's range
+        words = dict((str(i), str(random.random())) for i in range(N))
+        h = heapdict(words, reverse=True)
+        self.assertEqual(h.popmany(N), sorted(words.items(),
+                                              key=lambda x: x[1], reverse=True))
+        h = heapdict({'a': 2**70, 'b': 2**70 + 1, 'c': -2**70}, reverse=True)
+        self.assertEqual(h.items_below(2**70 + 1), [('c', -2**70), ('a', 2**70)])
+        self.assertEqual([h.pop() for i in range(3)], ['b', 'a', 'c'])
+        # range queries compare the values, not the reversed order
+        h = heapdict({'a': 1, 'b': 5, 'c': 3}, reverse=True)
+        self.assertEqual(h.count_below(3), 1)
+        self.assertEqual(h.items_below(4), [('a', 1), ('c', 3)])
+        self.assertEqual(h.items_in_range(1, 5), [('a', 1), ('c', 3)])
+        h = heapdict({'a': -4, 'b': 2, 'c': 3}, key=abs)
+        self.assertEqual(h.items_in_range(-4, 3), [('a', -4), ('b', 2)])
+
+
+class TestBlockingHeap(TestHeap):
+
+    def heapdict(self, *args, **kw):
+        kw.update(self.options)
+        return BlockingHeapDict(*args, **kw)
+
+    def test_engine(self):
+        h = BlockingHeapDict(engine='pairing')
+        self.assertIsInstance(h.h, PairingHeapDict)
+
+    def test_pop_timeout(self):
+        h = BlockingHeapDict()
+        self.assertRaises(IndexError, h.pop)
+        self.assertRaises(IndexError, h.pop, timeout=0.01)
+        h['a'] = 1
+        self.assertEqual(h.pop(), 'a')
+        h['b'] = 2
+        self.assertEqual(h.pop('b'), 2)
+        self.assertEqual(h.pop('b', None), None)
+
+    def test_pop_blocks(self):
+        h = BlockingHeapDict()
+        got = []
+        consumers = [threading.Thread(target=lambda: got.append(h.pop(timeout=None)))
+                     for i in range(4)]
+        for t in consumers:
+            t.start()
+        for i in range(4):
+            h[i] = random.random()
+        for t in consumers:
+            t.join(5)
+        self.assertEqual(sorted(got), list(range(4)))
+        self.assertEqual(len(h), 0)
+
+    def test_pop_due(self):
+        h = BlockingHeapDict([('late', 5), ('early', 2)])
+        self.assertEqual(h.pop_due(3), ('early', 2))
+        self.assertRaises(IndexError, h.pop_due, 3, timeout=0.01)
+        threading.Timer(0.01, h.__setitem__, ('now', 1)).start()
+        self.assertEqual(h.pop_due(3, timeout=5), ('now', 1))
+        self.assertEqual(h.peekitem(), ('late', 5))
+
+    def test_pop_due_clock(self):
+        h = BlockingHeapDict()
+        start = time.time()
+        h['later'] = start + 60
+        threading.Timer(0.01, h.__setitem__, ('soon', start + 0.05)).start()
+        self.assertEqual(h.pop_due(timeout=5), ('soon', start + 0.05))
+        self.assertGreaterEqual(time.time(), start + 0.05)
+        self.assertRaises(IndexError, h.pop_due, timeout=0.01)
+
+    def test_reprioritize(self):
+        h = BlockingHeapDict([('a', 1), ('b', 2)])
+        self.assertEqual(h.reprioritize('b', lambda v: v - 2), 0)
+        self.assertEqual(h.peekitem(), ('b', 0))
+        self.assertRaises(KeyError, h.reprioritize, 'c', abs)
+
+        def bump():
+            for i in range(1000):
+                h.reprioritize('a', lambda v: v + 1)
+        threads = [threading.Thread(target=bump) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(h['a'], 4001)
+        h._check_invariants()
+
+
+class TestBoundedHeap(TestHeap):
+
+    # Large enough that the conformance tests never evict.
+    options = {'maxsize': 10 * N}
+
+    def test_construct(self):
+        self.assertRaises(ValueError, heapdict, maxsize=0)
+        self.assertRaises(TypeError, heapdict, maxsize=1, engine='lazy')
+        self.assertRaises(TypeError, heapdict, maxsize=1, storage='compact')
+        self.assertRaises(TypeError, heapdict, maxsize=1, instrument=True)
+        self.assertRaises(TypeError, heapdict, on_evict=len, engine='pairing')
+        self.assertRaises(TypeError, LazyHeapDict, maxsize=1)
+        for engine in ('heap', 'lazy', 'pairing', 'radix', 'sorted', 'auto'):
+            h = heapdict({'a': 1}, engine=engine, maxsize=None, on_evict=None)
+            self.assertEqual(dict(h), {'a': 1})
+        self.assertEqual(dict(heapdict(storage='compact', maxsize=None)), {})
+        self.assertIsInstance(heapdict(maxsize=1, reverse=True), KeyedHeapDict)
+        evicted = []
+        h = heapdict([('a', 3), ('b', 1), ('c', 2)], maxsize=2,
+                     on_evict=lambda k, v: evicted.append((k, v)))
+        self.assertEqual(evicted, [('b', 1)])
+        self.assertEqual(dict(h), {'a': 3, 'c': 2})
+
+    def test_evict(self):
+        evicted = []
+        h = heapdict(maxsize=3, on_evict=lambda k, v: evicted.append((k, v)))
+        for k, v in [('a', 5), ('b', 3), ('c', 4)]:
+            h[k] = v
+        self.assertEqual(evicted, [])
+        h['d'] = 6
+        self.assertEqual(evicted, [('b', 3)])
+        # too low to keep: rejected without touching the heap
+        h['e'] = 1
+        self.assertEqual(evicted, [('b', 3), ('e', 1)])
+        self.assertNotIn('e', h)
+        # a tie replaces the top
+        h['f'] = 4
+        self.assertEqual(evicted, [('b', 3), ('e', 1), ('c', 4)])
+        # changing an existing key never evicts
+        h['a'] = 0
+        self.assertEqual(len(evicted), 3)
+        h._check_invariants()
+        self.assertEqual(h.popmany(3), [('a', 0), ('f', 4), ('d', 6)])
+
+    def test_top_k(self):
+        for reverse in (False, True):
+            for size in (1, N//20, 2*N):
+                pairs = [(random.random(), random.random()) for i in range(N)]
+                evicted = []
+                h = heapdict(maxsize=N//10, reverse=reverse,
+                             on_evict=lambda k, v: evicted.append((k, v)))
+                h.update(pairs[:N//2])
+                for i in range(N//2, N, size):
+                    h.update(pairs[i:i + size])
+                h._check_invariants()
+                pairs.sort(key=lambda x: x[1], reverse=not reverse)
+                self.assertEqual(sorted(h.items()), sorted(pairs[:N//10]))
+                self.assertEqual(sorted(evicted), sorted(pairs[N//10:]))
+
+    def test_merge_evicts(self):
+        # a larger unbounded heap is taken over and trimmed to maxsize.
+        pairs = [(random.random(), random.random()) for i in range(N)]
+        evicted = []
+        h = heapdict(pairs[:N//10], maxsize=N//10,
+                     on_evict=lambda k, v: evicted.append((k, v)))
+        h.merge(heapdict(pairs[N//10:]))
+        h._check_invariants()
+        pairs.sort(key=lambda x: x[1], reverse=True)
+        self.assertEqual(sorted(h.items()), sorted(pairs[:N//10]))
+        self.assertEqual(sorted(evicted), sorted(pairs[N//10:]))
+
+    def test_lfu(self):
+        counts = heapdict(maxsize=2)
+        for key in 'aabcbbd':
+            if counts.bump(key) is None:
+                counts[key] = 1
+        self.assertEqual(dict(counts), {'a': 2, 'b': 2})
+
+
+class TestRecordingHeap(unittest.TestCase):
+
+    def record(self, f):
+        h = RecordingHeapDict(f, [('a', 1), ('b', 2.5)], arity=4)
+        for i in range(10 * N):
+            op = random.random()
+            if op < 0.5:
+                h[random.randrange(N)] = random.random()
+            elif not h:
+                continue
+            elif op < 0.6:
+                h.peekitem()
+            elif op < 0.9:
+                h.popitem()
+            else:
+                h.pop(random.randrange(N), None)
+        h.pop_until(0.1)
+        h.update(c=3)
+        h._check_invariants()
+        return h
+
+    def test_replay(self):
+        f = io.BytesIO()
+        h = self.record(f)
+        f.seek(0)
+        # without ties, replaying gives the same heap with ids for keys.
+        replayed = heapdict()
+        for op, key, priority in read_trace(f):
+            try:
+                if op == 'set':
+                    replayed[key] = priority
+                elif op == 'del':
+                    del replayed[key]
+                elif op == 'pop':
+                    replayed.popitem()
+                else:
+                    replayed.peekitem()
+            except IndexError:
+                pass
+        self.assertEqual(dict(replayed), dict((h.ids[k], v) for k, v in h.items()))
+        # ids are reused, so there are no more than the most keys held.
+        self.assertLessEqual(len(h.ids) + len(h.free), N + 2)
+
+    def test_format(self):
+        f = io.BytesIO()
+        h = RecordingHeapDict(f)
+        h['x'] = 7
+        h['y'] = 0.5
+        self.assertEqual(h.pop(), 'y')
+        del h['x']
+        self.assertRaises(IndexError, h.peekitem)
+        self.assertRaises(KeyError, h.__delitem__, 'x')
+        self.assertRaises(TypeError, h.__setitem__, 'z', 'high')
+        self.assertNotIn('z', h)
+        self.assertEqual(len(f.getvalue()), 8 + 13 + 13 + 1 + 5 + 1)
+        f.seek(0)
+        self.assertEqual(list(read_trace(f)), [
+            ('set', 0, 7), ('set', 1, 0.5), ('pop', None, None),
+            ('del', 0, None), ('peek', None, None)])
+        self.assertRaises(ValueError, list, read_trace(io.BytesIO(b'HEAPDICT')))
+        truncated = io.BytesIO(f.getvalue()[:-2])
+        self.assertRaises(ValueError, list, read_trace(truncated))
+
+    def test_transaction(self):
+        f = io.BytesIO()
+        h = RecordingHeapDict(f, [('x', 3), ('y', 2)])
+        ids = dict(h.ids)
+        with h.transaction() as t:
+            t['z'] = 1
+            self.assertEqual(t.nsmallest(2), [('z', 1), ('y', 2)])
+            self.assertEqual(t.popitem(), ('z', 1))
+            self.assertEqual(t.peekitem(), ('y', 2))
+            del t['x']
+            t['y'] = 4
+        self.assertEqual(dict(h), {'y': 4})
+        f.seek(0)
+        self.assertEqual(list(read_trace(f))[2:],
+                         [('del', ids['x'], None), ('set', ids['y'], 4)])
+
+
+class TestShardedHeap(unittest.TestCase):
+
+    def sharded(self, *args, **kw):
+        h = ShardedHeapDict(*args, **kw)
+        self.addCleanup(h.close)
+        return h
+
+    def test_operations(self):
+        h = self.sharded(shards=3)
+        self.assertRaises(IndexError, h.popitem)
+        self.assertRaises(IndexError, h.peekitem)
+        d = {}
+        for i in range(10 * N):
+            k = random.randrange(N)
+            op = random.random()
+            if op < 0.6:
+                d[k] = h[k] = random.random()
+            elif op < 0.8 and k in d:
+                del d[k]
+                del h[k]
+            elif d:
+                self.assertEqual(h.peekitem(), min(d.items(), key=lambda x: x[1]))
+                k, v = h.popitem()
+                self.assertEqual(d.pop(k), v)
+            self.assertEqual(len(h), len(d))
+        h._check_invariants()
+        self.assertEqual(dict(h), d)
+        self.assertRaises(KeyError, h.__getitem__, 'missing')
+        self.assertRaises(KeyError, h.__delitem__, 'missing')
+        self.assertEqual(h.pop('missing', None), None)
+        h.clear()
+        self.assertEqual(len(h), 0)
+        self.assertFalse(h.tops)
+
+    def test_batches(self):
+        d = dict((i, random.randrange(N)) for i in range(10 * N))
+        h = self.sharded(d, shards=4)
+        self.assertEqual(sorted(h.sizes), sorted(
+            sum(1 for k in d if hash(k) % 4 == i) for i in range(4)))
+        expected = sorted(d.items(), key=lambda x: x[1])
+        self.assertEqual([v for _, v in h.nsmallest(N)],
+                         [v for _, v in expected[:N]])
+        items = h.popmany(N)
+        self.assertEqual([v for _, v in items], [v for _, v in expected[:N]])
+        for k, v in items:
+            self.assertEqual(d.pop(k), v)
+        items = h.pop_until(N // 2)
+        self.assertEqual(sorted(items, key=lambda x: x[1]), items)
+        self.assertEqual(dict(items),
+                         dict((k, v) for k, v in d.items() if v <= N // 2))
+        for k, _ in items:
+            del d[k]
+        k = max(d, key=d.get)
+        self.assertEqual(h.bump(k, 5), d[k] + 5)
+        d[k] += 5
+        self.assertEqual(h.bump('missing'), None)
+        self.assertEqual(h.pop(k), d.pop(k))
+        h._check_invariants()
+        self.assertEqual(len(h), len(d))
+        self.assertEqual(dict(h), d)
+        self.assertEqual(h.count_below(N), sum(1 for v in d.values() if v < N))
+        items = h.items_in_range(N // 2, N)
+        self.assertEqual(sorted(items, key=operator.itemgetter(1)), items)
+        self.assertEqual(dict(items),
+                         dict((k, v) for k, v in d.items() if N // 2 <= v < N))
+
+    def test_options(self):
+        self.assertRaises(ValueError, ShardedHeapDict, engine='bogus')
+        self.assertRaises(ValueError, ShardedHeapDict, maxsize=10)
+        with ShardedHeapDict(shards=2, reverse=True) as h:
+            h.update((i, i) for i in range(N))
+            self.assertEqual(h.peekitem(), (N - 1, N - 1))
+            self.assertEqual(h.popmany(3), [(N - 1, N - 1), (N - 2, N - 2),
+                                            (N - 3, N - 3)])
+            self.assertEqual(h.pop_until(N - 5), [(N - 4, N - 4),
+                                                  (N - 5, N - 5)])
+            self.assertEqual(h.items_in_range(2, 5), [(2, 2), (3, 3), (4, 4)])
+        for process in h.processes:
+            self.assertFalse(process.is_alive())
+        self.assertTrue(h.closed)
+        for method, args in [('__setitem__', (1, 1)), ('__getitem__', (1,)),
+                             ('__len__', ()), ('popitem', ()),
+                             ('peekitem', ()), ('nsmallest', (1,)),
+                             ('update', ({1: 1},))]:
+            self.assertRaises(ValueError, getattr(h, method), *args)
+        h.close()
+
+
+class TestExpiringDict(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+
+    def clock(self):
+        return self.now
+
+    def test_expiry(self):
+        d = ExpiringDict(10, clock=self.clock)
+        d['a'] = 1
+        self.now = 5
+        d['b'] = 2
+        self.assertEqual(d['a'], 1)
+        self.assertEqual(sorted(d), ['a', 'b'])
+        self.now = 10
+        self.assertRaises(KeyError, d.__getitem__, 'a')
+        self.assertNotIn('a', d)
+        self.assertEqual(d.get('a'), None)
+        self.assertEqual(list(d), ['b'])
+        self.assertEqual(len(d), 1)
+        self.now = 15
+        self.assertRaises(KeyError, d.__delitem__, 'b')
+        self.assertEqual(len(d), 0)
+
+    def test_ttl(self):
+        d = ExpiringDict(10, clock=self.clock, refresh=True)
+        d.set('short', 1, ttl=2)
+        d['long'] = 2
+        self.now = 1
+        self.assertEqual(d['short'], 1)
+        self.now = 2.5
+        self.assertEqual(d['short'], 1)
+        self.now = 3.5
+        self.assertIn('short', d)
+        self.now = 4.5
+        self.assertNotIn('short', d)
+        self.now = 9
+        self.assertEqual(d['long'], 2)
+        self.now = 18
+        self.assertIn('long', d)
+        self.assertEqual(d.expiries['long'], 19)
+
+    def test_batch(self):
+        d = ExpiringDict(1, clock=self.clock, batch=10)
+        d.update((i, i) for i in range(N))
+        self.now = 1
+        d['new'] = 0
+        self.assertEqual(len(d), N - 10 + 1)
+        for i in range(5):
+            d['new%d' % i] = i
+        self.assertEqual(len(d), N - 60 + 6)
+        self.assertEqual(d.expire(limit=7), 7)
+        self.assertEqual(d.expire(), N - 67)
+        self.assertEqual(sorted(d), ['new', 'new0', 'new1', 'new2', 'new3', 'new4'])
+        d.expiries._check_invariants()
+
+    def test_sweeper(self):
+        d = ExpiringDict(0.01, batch=3)
+        d.update((i, i) for i in range(N))
+        d.start_sweeper(0.01)
+        self.assertRaises(RuntimeError, d.start_sweeper)
+        deadline = time.time() + 5
+        while len(d) and time.time() < deadline:
+            time.sleep(0.01)
+        d.stop_sweeper()
+        self.assertEqual(len(d), 0)
+        self.assertIsNone(d.sweeper)
+
+
+@unittest.skipIf(AsyncHeapDict is None, 'AsyncHeapDict needs Python 3.7')
+class TestAsyncHeap(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.run = self.loop.run_until_complete
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_mapping(self):
+        pairs = [(random.random(), random.random()) for i in range(N)]
+        h = AsyncHeapDict(pairs, engine='pairing')
+        self.assertEqual(len(h), N)
+        self.assertEqual(dict(h.items()), dict(pairs))
+        pairs.sort(key=lambda x: x[1])
+        self.assertEqual(h.peekitem(), pairs[0])
+        self.assertEqual(h.nsmallest(3), pairs[:3])
+        self.assertEqual(h.popitem(), pairs[0])
+        self.assertEqual(self.run(h.pop()), pairs[1][0])
+        self.assertEqual(self.run(h.pop(pairs[2][0])), pairs[2][1])
+        self.assertEqual(h.popmany(2), pairs[3:5])
+        del h[pairs[5][0]]
+        self.assertNotIn(pairs[5][0], h)
+        h._check_invariants()
+        h.clear()
+        self.assertEqual(len(h), 0)
+
+    def test_transaction(self):
+        h = AsyncHeapDict([('x', 3), ('y', 2)])
+        with h.transaction() as t:
+            t['z'] = 1
+            self.assertEqual(t.nsmallest(2), [('z', 1), ('y', 2)])
+            self.assertEqual(t.popitem(), ('z', 1))
+            self.assertEqual(t.peekitem(), ('y', 2))
+            del t['x']
+        self.assertEqual(dict(h), {'y': 2})
+        # committing wakes a waiting pop_due()
+        def commit():
+            with h.transaction() as t:
+                t['w'] = 0
+        self.loop.call_later(0.01, commit)
+        self.assertEqual(self.run(h.pop_due(now=1, timeout=5)), ('w', 0))
+
+    def test_pop_waits(self):
+        h = AsyncHeapDict()
+        self.assertRaises(IndexError, self.run, h.pop(timeout=0.01))
+        self.loop.call_later(0.01, h.__setitem__, 'a', 1)
+        self.assertEqual(self.run(h.pop(timeout=5)), 'a')
+        self.loop.call_later(0.01, h.update, [('b', 2), ('c', 1)])
+        tasks = [self.loop.create_task(h.pop()) for i in range(2)]
+        self.assertEqual(self.run(asyncio.gather(*tasks)), ['c', 'b'])
+        self.assertFalse(h.waiters)
+        self.loop.call_later(0.01, h.merge, heapdict({'d': 1}))
+        self.assertEqual(self.run(h.pop(timeout=5)), 'd')
+
+    def test_pop_cancelled(self):
+        h = AsyncHeapDict()
+        first = self.loop.create_task(h.pop())
+        second = self.loop.create_task(h.pop())
+        self.run(asyncio.sleep(0))
+        h['a'] = 1
+        first.cancel()
+        self.assertEqual(self.run(second), 'a')
+        self.assertTrue(first.cancelled())
+
+    def test_pop_due(self):
+        h = AsyncHeapDict([('late', 5), ('early', 2)])
+        self.assertEqual(self.run(h.pop_due(3)), ('early', 2))
+        self.assertRaises(IndexError, self.run, h.pop_due(3, timeout=0.01))
+        self.loop.call_later(0.01, h.__setitem__, 'now', 1)
+        self.assertEqual(self.run(h.pop_due(3, timeout=5)), ('now', 1))
+        self.assertEqual(h.peekitem(), ('late', 5))
+
+    def test_pop_due_clock(self):
+        h = AsyncHeapDict()
+        start = self.loop.time()
+        h['later'] = start + 60
+        self.loop.call_later(0.01, h.__setitem__, 'soon', start + 0.05)
+        self.assertEqual(self.run(h.pop_due(timeout=5)), ('soon', start + 0.05))
+        self.assertGreaterEqual(self.loop.time(), start + 0.05)
+        self.assertRaises(IndexError, self.run, h.pop_due(timeout=0.01))
+        self.assertFalse(h.due_waiters)
+
+        h = AsyncHeapDict([('a', 10)], clock=lambda: 10)
+        self.assertEqual(self.run(h.pop_due()), ('a', 10))
+
 
 def test_main(verbose=None):
-    test_classes = [TestHeap]
+    test_classes = [TestHeap, TestSnapshot, TestDaryHeap, TestCompactHeap,
+                    TestLazyHeap, TestPairingHeap, TestRadixHeap, TestCalendarHeap,
+                    TestNumpyHeap, TestSortedHeap, TestAutoHeap,
+                    TestInstrumentedHeap, TestKeyedHeap, TestBoundedHeap,
+                    TestBlockingHeap, TestRecordingHeap, TestShardedHeap,
+                    TestExpiringDict,
+                    TestAsyncHeap]
     test_support.run_unittest(*test_classes)
 
     # verify reference counting
@@ -149,11 +1492,3 @@ def test_main(verbose=None):
 
 if __name__ == "__main__":
     test_main(verbose=True)
-
-    originout = sys.stdout
-    with tempfile.TemporaryFile(mode="w") as tmp:
-        sys.stdout = tmp
-        total = min(timeit.repeat("test_main()", number=20, repeat=3, setup="from __main__ import test_main"))
-
-    sys.stdout = originout
-    print("Timeit: {} s".format(total))